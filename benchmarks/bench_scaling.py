@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Measures how dbup scales with the size of the catalog.
+
+Generates synthetic DirectoryVersionCatalog trees and times catalog scanning,
+stage loading, upgrade/downgrade planning and end-to-end upgrades against
+a sqlite file. Results are printed (or written with -o) as JSON, so runs
+of different releases can be compared by a script.
+
+    python benchmarks/bench_scaling.py -s 100,1000,10000 -o results.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import platform
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from dbup.compat import json
+from dbup.manager import Manager
+from dbup.worker import SqlWorker, NoInstallation
+from dbup.version_catalog import DirectoryVersionCatalog
+
+
+SMALL_STAGE = '''class Stage(object):
+    def up(self, session):
+        session.execute("create table t%(n)d (id integer)")
+
+    def down(self, session):
+        session.execute("drop table t%(n)d")
+'''
+
+# roughly what a stage with a few dozen statements and some helpers looks like
+LARGE_STAGE = SMALL_STAGE + "".join([ '''
+    def helper_%(i)d(self, session):
+        """
+        Not called, only makes file bigger to parse.
+        """
+        rows = [ (x, x * 2, "value %%%%d" %%%% x) for x in range(100) ]
+        for row in rows:
+            session.execute("insert into t%%(n)d values (%%%%d)" %%%% row[0])
+''' % {'i': i} for i in range(40) ])
+
+
+def generate_catalog(path, count, stage_size):
+    template = stage_size == 'large' and LARGE_STAGE or SMALL_STAGE
+    width = len(str(count))
+    for n in range(1, count + 1):
+        version_path = os.path.join(path, str(n).zfill(width))
+        os.mkdir(version_path)
+        f = open(os.path.join(version_path, '__init__.py'), 'w')
+        f.write(template % {'n': n})
+        f.close()
+
+
+class PlanningWorker(object):
+    """
+    Worker that pretends to be at some version and throws planned stages away,
+    so only planning is measured.
+    """
+    def __init__(self, current_version=None):
+        self.current_version = current_version
+
+    def get_current_version(self):
+        if self.current_version is None:
+            raise NoInstallation()
+        return self.current_version
+
+    def upgrade(self, stages):
+        pass
+
+    def downgrade(self, stages):
+        pass
+
+
+def timeit(func, repeat):
+    """
+    Returns best time of 'repeat' calls of func.
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_catalog(tmp_dir, count, stage_size, repeat, e2e_max):
+    results = []
+    def add(name, seconds, **extra):
+        result = {'name': name, 'versions': count, 'stage_size': stage_size, 'seconds': seconds}
+        result.update(extra)
+        results.append(result)
+        sys.stderr.write("%-32s %7d %-6s %.6f\n" % (name, count, stage_size, seconds))
+
+    catalog_path = os.path.join(tmp_dir, 'catalog-%d-%s' % (count, stage_size))
+    os.mkdir(catalog_path)
+    generate_catalog(catalog_path, count, stage_size)
+    # freshly modified directories are always rescanned, pretend it's an old catalog
+    an_hour_ago = time.time() - 3600
+    os.utime(catalog_path, (an_hour_ago, an_hour_ago))
+    cache_dir = os.path.join(tmp_dir, 'cache-%d-%s' % (count, stage_size))
+
+    add('get_available_versions.scan',
+        timeit(lambda: DirectoryVersionCatalog(catalog_path).get_available_versions(), repeat))
+    DirectoryVersionCatalog(catalog_path, cache_dir=cache_dir).get_available_versions()
+    add('get_available_versions.manifest',
+        timeit(lambda: DirectoryVersionCatalog(catalog_path, cache_dir=cache_dir).get_available_versions(), repeat))
+    catalog = DirectoryVersionCatalog(catalog_path)
+    versions = catalog.get_available_versions()
+    add('get_available_versions.warm', timeit(catalog.get_available_versions, repeat))
+
+    sample = versions[::max(1, len(versions) // 100)]
+    seconds = timeit(lambda: [ catalog.load_stage(version) for version in sample ], repeat)
+    add('load_stage', seconds / len(sample), per='stage')
+
+    middle = versions[len(versions) // 2]
+    add('plan.upgrade.fresh',
+        timeit(lambda: Manager(worker=PlanningWorker(), catalog=catalog).upgrade(None), repeat))
+    add('plan.upgrade.from_middle',
+        timeit(lambda: Manager(worker=PlanningWorker(middle), catalog=catalog).upgrade(None), repeat))
+    add('plan.downgrade.to_first',
+        timeit(lambda: Manager(worker=PlanningWorker(versions[-1]), catalog=catalog).downgrade(versions[0]), repeat))
+
+    if count <= e2e_max:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        def upgrade():
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            engine = sqlalchemy.create_engine('sqlite:///%s' % db_path)
+            try:
+                Manager(worker=SqlWorker(engine=engine), catalog=catalog).upgrade(None)
+            finally:
+                engine.dispose()
+        add('upgrade.sqlite', timeit(upgrade, 1))
+    return results
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sizes',
+                      default="100,1000,10000",
+                      help="Comma separated numbers of versions, default is 100,1000,10000.")
+    parser.add_option('--stage-sizes',
+                      default="small,large",
+                      help="Comma separated stage sizes (small, large), default is both.")
+    parser.add_option('-r', '--repeat',
+                      default=3,
+                      type="int",
+                      help="Take best of that many runs, default is 3.")
+    parser.add_option('--e2e-max',
+                      default=10000,
+                      type="int",
+                      metavar="N",
+                      help="Run end-to-end sqlite upgrades only for catalogs up to N versions.")
+    parser.add_option('-o', '--output',
+                      default=None,
+                      metavar="PATH",
+                      help="Write JSON results to PATH instead of stdout.")
+    options, _arguments = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix='dbup-bench-')
+    results = []
+    try:
+        for stage_size in options.stage_sizes.split(','):
+            for count in [ int(size) for size in options.sizes.split(',') ]:
+                results.extend(bench_catalog(tmp_dir, count, stage_size,
+                                             options.repeat, options.e2e_max))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'sqlalchemy': sqlalchemy.__version__,
+              'platform': platform.platform(),
+              'results': results}
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        print data
+
+
+if __name__ == '__main__':
+    main()
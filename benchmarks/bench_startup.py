@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Measures how long it takes dbup to start.
+
+Every measurement runs a fresh interpreter, the way deploy hooks run dbup:
+importing dbup, and 'dbup status' against a sqlite file with and without
+an installation. Results are printed (or written with -o) as JSON.
+It also checks that importing dbup does not import sqlalchemy, with
+--strict the script fails if it does.
+
+    python benchmarks/bench_startup.py -r 10 -o startup.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from dbup.compat import json
+
+# modules that importing dbup alone should not drag in
+HEAVY_MODULES = ['sqlalchemy', 'sqlalchemy.orm']
+
+STAGE = '''class Stage(object):
+    def up(self, session):
+        session.execute("create table t (id integer)")
+
+    def down(self, session):
+        session.execute("drop table t")
+'''
+
+
+def run(code, repeat):
+    """
+    Returns best wall time of 'repeat' fresh interpreters running code.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [ p for p in [env.get('PYTHONPATH')] if p ])
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        elapsed = time.time() - started
+        if process.returncode != 0:
+            raise Exception("Failed to run %r: %s" % (code, err))
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def get_imported(module):
+    """
+    Returns those of HEAVY_MODULES that get imported along with module.
+    """
+    code = "import sys; import %s; print ' '.join([ m for m in %r if m in sys.modules ])" % \
+           (module, HEAVY_MODULES)
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE)
+    out, _err = process.communicate()
+    return out.split()
+
+def dbup_command(*arguments):
+    return "import dbup; dbup.main(%r)" % (['dbup'] + list(arguments))
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-r', '--repeat',
+                      default=5,
+                      type="int",
+                      help="Take best of that many runs, default is 5.")
+    parser.add_option('--strict',
+                      default=False,
+                      action="store_true",
+                      help="Exit with non-zero code if importing dbup imports sqlalchemy.")
+    parser.add_option('-o', '--output',
+                      default=None,
+                      metavar="PATH",
+                      help="Write JSON results to PATH instead of stdout.")
+    options, _arguments = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix='dbup-bench-')
+    results = []
+    def add(name, seconds):
+        results.append({'name': name, 'seconds': seconds})
+        sys.stderr.write("%-32s %.6f\n" % (name, seconds))
+    try:
+        catalog_path = os.path.join(tmp_dir, 'catalog')
+        os.makedirs(os.path.join(catalog_path, '1'))
+        f = open(os.path.join(catalog_path, '1', '__init__.py'), 'w')
+        f.write(STAGE)
+        f.close()
+        installed = 'sqlite:///%s' % os.path.join(tmp_dir, 'installed.db')
+        empty = 'sqlite:///%s' % os.path.join(tmp_dir, 'empty.db')
+        run(dbup_command('up', '-p', catalog_path, '-c', installed), 1)
+
+        add('python', run("pass", options.repeat))
+        add('import.sqlalchemy', run("import sqlalchemy", options.repeat))
+        add('import.sqlalchemy.orm', run("import sqlalchemy.orm", options.repeat))
+        add('import.dbup', run("import dbup", options.repeat))
+        add('status.installed', run(dbup_command('status', '-p', catalog_path, '-c', installed),
+                                    options.repeat))
+        add('status.no_installation', run("import dbup\ntry:\n    %s\nexcept SystemExit:\n    pass" % \
+                                          dbup_command('status', '-p', catalog_path, '-c', empty),
+                                          options.repeat))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    heavy = get_imported('dbup')
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'heavy_modules_on_import': heavy,
+              'results': results}
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        print data
+    if heavy and options.strict:
+        sys.stderr.write("Importing dbup imports %s.\n" % ", ".join(heavy))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import time
+import threading
+
+from dbup.compat import json
+from dbup.version_catalog import DirectoryVersionCatalog, write_file_atomically
+
+
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+def get_catalog(path, cache_dir=None):
+    """
+    Returns catalog for directory or bundle file specified, the same one
+    for every call, so its manifest is only read once per process.
+    """
+    key = (os.path.abspath(path), cache_dir)
+    catalogs_lock.acquire()
+    try:
+        catalog = catalogs.get(key)
+        if catalog is None:
+            if os.path.isfile(path):
+                from dbup.version_catalog.bundle import BundleVersionCatalog
+                catalog = BundleVersionCatalog(path, extract_dir=cache_dir)
+            else:
+                catalog = DirectoryVersionCatalog(path, cache_dir=cache_dir)
+            catalogs[key] = catalog
+        return catalog
+    finally:
+        catalogs_lock.release()
+
+def get_latest_version(catalog, sort_key=None):
+    """
+    Returns the newest version of catalog, or None if catalog is empty.
+    catalog - catalog instance or path to catalog directory.
+    """
+    if isinstance(catalog, basestring):
+        catalog = get_catalog(catalog)
+    versions = catalog.get_available_versions()
+    if not versions:
+        return None
+    if sort_key is None:
+        return versions[-1]
+    return max(versions, key=sort_key)
+
+def get_installed_version(connection, version_table='dbup_version'):
+    """
+    Returns version installed in database, or None if there is no installation.
+    connection - existing connection to query, either sqlalchemy or DB-API one.
+    """
+    query = "select current_version from %s" % version_table
+    try:
+        if hasattr(connection, 'execute'):
+            record = connection.execute(query).fetchone()
+        else:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query)
+                record = cursor.fetchone()
+            finally:
+                cursor.close()
+    except Exception:
+        # no version table, database is not installed.
+        # sqlalchemy rolls back by itself outside of transaction, DB-API connections don't
+        if not hasattr(connection, 'execute'):
+            connection.rollback()
+        return None
+    if record is None or record[0] is None:
+        return None
+    return record[0].strip()
+
+
+class VersionStatus(object):
+    """
+    Version installed in database (None if not installed) and the newest one in catalog.
+    """
+    def __init__(self, installed, latest, checked_at=None):
+        self.installed = installed
+        self.latest = latest
+        self.checked_at = checked_at or time.time()
+
+    def is_up_to_date(self):
+        return self.installed is not None and self.installed == self.latest
+
+    def __str__(self):
+        return "installed \"%s\", latest \"%s\"" % (self.installed, self.latest)
+
+
+def check_version(connection, catalog, version_table='dbup_version', sort_key=None,
+                  cache_path=None, ttl=5.0):
+    """
+    Compares version installed in database with the newest one in catalog,
+    cheap enough to be called by every process of an application when it starts:
+        status = check_version(engine.connect(), 'versions',
+                               cache_path='/tmp/myapp-schema-check', ttl=10)
+        if not status.is_up_to_date():
+            raise RuntimeError("Database schema is stale: %s" % status)
+    catalog - catalog instance or path to catalog directory, directories are
+              only scanned once per process, see get_catalog.
+    Runs a single query on the connection given. If cache_path is specified,
+    result is kept there for 'ttl' seconds and shared by all processes using
+    the same path, so only one of them queries database and catalog in that time.
+    Returns VersionStatus.
+    """
+    if cache_path is not None:
+        status = read_cached_status(cache_path, ttl)
+        if status is not None:
+            return status
+    status = VersionStatus(get_installed_version(connection, version_table),
+                           get_latest_version(catalog, sort_key))
+    if cache_path is not None:
+        write_cached_status(cache_path, status)
+    return status
+
+def is_up_to_date(connection, catalog, **kwargs):
+    """
+    Returns True if database is at the newest version of catalog, see check_version.
+    """
+    return check_version(connection, catalog, **kwargs).is_up_to_date()
+
+def read_cached_status(path, ttl):
+    """
+    Returns VersionStatus stored in file at path, or None if there is none or it's older than ttl.
+    """
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            return None
+        f = open(path, 'r')
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            data = json.load(f)
+            checked_at = data['checked_at']
+            if time.time() - checked_at > ttl:
+                return None
+            return VersionStatus(data['installed'], data['latest'], checked_at)
+        except (IOError, ValueError, KeyError, TypeError):
+            # not a status written by write_cached_status, check again
+            return None
+    finally:
+        f.close()
+
+def write_cached_status(path, status):
+    # status is checked in database again if it cannot be saved
+    try:
+        write_file_atomically(path, json.dumps({'installed': status.installed,
+                                                'latest': status.latest,
+                                                'checked_at': status.checked_at}))
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+
+from dbup.database.helpers import has_table
+
+
+PROGRESS_TABLE = 'dbup_backfill'
+
+
+def backfill(session, table, key, statement, chunk_size=1000, name=None,
+             sleep=0, rows_per_second=None, probe=None, progress_table=PROGRESS_TABLE):
+    """
+    Runs statement for consecutive ranges of table's key, committing after every range,
+    so large data migrations do not lock the table and grow transaction log for hours.
+    Usage from stage:
+        backfill(session, 'users', 'id',
+                 "update users set email_lower = lower(email) where id >= :lo and id <= :hi")
+
+    statement - SQL with :lo and :hi parameters, first and last key of the range (inclusive)
+    chunk_size - how many rows each range covers
+    name - name progress is remembered under, table.key by default.
+           If backfill is interrupted, next call with the same name continues after
+           the last committed range.
+    sleep - seconds to sleep after every range
+    rows_per_second - do not go faster than that
+    probe - callable that gets session and returns number of seconds to wait
+            before the next range (or 0/None), e.g. to back off while replicas are lagging.
+
+    Note that session is committed after every range, together with everything
+    executed in it before backfill. Put backfill into its own stage and consider
+    running upgrade with checkpoints.
+    Progress is reported in rows via session.report_progress.
+    Returns number of rows processed by this call.
+    """
+    if name is None:
+        name = "%s.%s" % (table, key)
+    setup_progress_table(session, progress_table)
+    last_key = get_last_key(session, progress_table, name)
+    processed = 0
+    while True:
+        if probe is not None:
+            delay = probe(session)
+            if delay:
+                time.sleep(delay)
+        started = time.time()
+        if last_key is None:
+            ret = session.execute("select min(%(key)s), max(%(key)s), count(*) from "
+                                  "(select %(key)s from %(table)s order by %(key)s limit %(limit)d) chunk"
+                                  % {'key': key, 'table': table, 'limit': chunk_size})
+        else:
+            ret = session.execute("select min(%(key)s), max(%(key)s), count(*) from "
+                                  "(select %(key)s from %(table)s where %(key)s > :last "
+                                  "order by %(key)s limit %(limit)d) chunk"
+                                  % {'key': key, 'table': table, 'limit': chunk_size},
+                                  {'last': last_key})
+        lo, hi, count = ret.fetchone()
+        if not count:
+            break
+        session.execute(statement, {'lo': lo, 'hi': hi})
+        save_last_key(session, progress_table, name, hi)
+        session.commit()
+        last_key = hi
+        processed += count
+        session.report_progress(processed, None, 'rows')
+        elapsed = time.time() - started
+        delay = sleep
+        if rows_per_second:
+            delay = max(delay, float(count) / rows_per_second - elapsed)
+        if delay > 0:
+            time.sleep(delay)
+    # done, next backfill with the same name starts from scratch
+    session.execute("delete from %s where name = :name" % progress_table, {'name': name})
+    session.commit()
+    return processed
+
+def setup_progress_table(session, progress_table=PROGRESS_TABLE):
+    """
+    Creates progress table unless there is one already. Table is looked up
+    rather than created blindly, a failed CREATE would abort the transaction
+    of the stage (and of the stages before it, unless run with checkpoints).
+    """
+    if has_table(session, progress_table):
+        return
+    session.execute("create table %s (name varchar(255), last_key varchar(255), key_type char(10));"
+                    % progress_table)
+
+def get_last_key(session, progress_table, name):
+    """
+    Returns last key committed by backfill with name specified, or None.
+    """
+    ret = session.execute("select last_key, key_type from %s where name = :name" % progress_table,
+                          {'name': name})
+    record = ret.fetchone()
+    if record is None:
+        return None
+    last_key, key_type = record[0], record[1].strip()
+    if key_type == 'int':
+        return int(last_key)
+    return last_key
+
+def save_last_key(session, progress_table, name, last_key):
+    if isinstance(last_key, (int, long)):
+        key_type = 'int'
+    else:
+        key_type = 'str'
+    session.execute("delete from %s where name = :name" % progress_table, {'name': name})
+    session.execute("insert into %s values (:name, :last_key, :key_type)" % progress_table,
+                    {'name': name, 'last_key': str(last_key), 'key_type': key_type})
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import re
+import sys
+import time
+import threading
+import Queue
+
+import sqlalchemy
+
+from dbup.database.helpers import get_dialect_name
+
+
+re_create_index = re.compile(r'^\s*create\s+(?:unique\s+)?index\s+(?P<concurrently>concurrently\s+)?'
+                             r'(?:if\s+not\s+exists\s+)?(?P<name>[\w."]+)\s+on\s+(?P<table>[\w."]+)',
+                             re.IGNORECASE)
+re_index_keyword = re.compile(r'\bindex\s+', re.IGNORECASE)
+
+
+class DdlError(Exception):
+    """
+    Raised by build_concurrently when some of statements failed.
+    failures - list of (statement, exception)
+    """
+    def __init__(self, failures):
+        lines = [ "  %s: %s" % (statement.strip(), error) for statement, error in failures ]
+        Exception.__init__(self, "%d statement(s) failed:\n%s" % (len(failures), "\n".join(lines)))
+        self.failures = failures
+
+
+def make_concurrent(statement):
+    """
+    Returns CREATE INDEX statement that does not block writes to the table on postgres.
+    Other statements are returned as they are.
+    """
+    match = re_create_index.match(statement)
+    if match is None or match.group('concurrently'):
+        return statement
+    return re_index_keyword.sub('INDEX CONCURRENTLY ', statement, 1)
+
+def get_drop_statement(dialect_name, statement):
+    """
+    Returns statement that drops index created by statement, or None if it's not CREATE INDEX.
+    """
+    match = re_create_index.match(statement)
+    if match is None:
+        return None
+    if dialect_name == 'mysql':
+        return "DROP INDEX %s ON %s" % (match.group('name'), match.group('table'))
+    return "DROP INDEX IF EXISTS %s" % match.group('name')
+
+def build_concurrently(session, statements, concurrency=4, online=True):
+    """
+    Runs independent DDL statements, such as CREATE INDEX, at the same time,
+    each on its own connection. Usage from stage:
+        build_concurrently(session, ["CREATE INDEX users_email ON users (email)",
+                                     "CREATE INDEX orders_user ON orders (user_id)"])
+
+    concurrency - how many statements run at the same time
+    online - on postgres, build indexes with CREATE INDEX CONCURRENTLY, which
+             does not block writes to the table, but cannot run in a transaction,
+             so such statements are committed on their own.
+    Sqlite cannot have several writers, statements are run one after another there.
+
+    Note that session is committed first, so that tables created before are
+    visible to other connections and no locks are held for them. Whatever the
+    stage did before the call stays committed even if an index fails to build,
+    so call it from a stage that only builds indexes. Without checkpoints the
+    commit also covers every earlier stage of the run, but not their versions,
+    so if a later stage fails the next run applies them again. Run upgrades
+    with such stages with checkpoints.
+    If any statement fails, no new ones are started. Once running ones are
+    finished, indexes built by this call are dropped, and so are invalid ones
+    left by failed concurrent builds, then DdlError listing every failure
+    is raised. Other DDL cannot be undone and is left as it is.
+    Progress is reported in statements via session.report_progress.
+    Returns list of (statement, seconds) in the order of statements.
+    """
+    dialect_name = (get_dialect_name(session) or '').lower()
+    postgres = dialect_name.startswith('postgres')
+    if postgres and online:
+        statements = [ make_concurrent(statement) for statement in statements ]
+    if session.transaction_active:
+        session.commit()
+    if dialect_name == 'sqlite':
+        concurrency = 1
+    engine = session.connection.engine
+    queue = Queue.Queue()
+    for idx, statement in enumerate(statements):
+        queue.put((idx, statement))
+    timings = [None] * len(statements)
+    failures = []
+    lock = threading.Lock()
+    def build():
+        while True:
+            lock.acquire()
+            try:
+                if failures:
+                    return
+            finally:
+                lock.release()
+            try:
+                idx, statement = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                seconds = execute_on_own_connection(engine, statement, autocommit=postgres and online)
+            except Exception:
+                lock.acquire()
+                try:
+                    failures.append((idx, statement, sys.exc_info()[1]))
+                finally:
+                    lock.release()
+                continue
+            lock.acquire()
+            try:
+                timings[idx] = (statement, seconds)
+                done = len([ timing for timing in timings if timing is not None ])
+            finally:
+                lock.release()
+            session.report_progress(done, len(statements), 'statements')
+    threads = [ threading.Thread(target=build) for _ in range(max(1, min(concurrency, len(statements)))) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        built = [ timing[0] for timing in timings if timing is not None ]
+        if postgres:
+            # failed concurrent build leaves invalid index behind,
+            # a failed statement may also be about an index that existed before, that one stays
+            built.extend([ statement for _idx, statement, _error in failures
+                           if is_invalid_index(engine, statement) ])
+        for statement in built:
+            drop = get_drop_statement(dialect_name, statement)
+            if drop is None:
+                continue
+            try:
+                execute_on_own_connection(engine, drop, autocommit=postgres and online)
+            except Exception:
+                pass
+        failures.sort()
+        raise DdlError([ (statement, error) for _idx, statement, error in failures ])
+    return timings
+
+def is_invalid_index(engine, statement):
+    """
+    Returns True if index created by statement exists and is marked invalid, postgres only.
+    """
+    match = re_create_index.match(statement)
+    if match is None:
+        return False
+    name = match.group('name').split('.')[-1].strip('"')
+    connection = engine.connect()
+    try:
+        try:
+            ret = connection.execute(sqlalchemy.text("select 1 from pg_index i join pg_class c on c.oid = i.indexrelid "
+                                                     "where c.relname = :name and not i.indisvalid"),
+                                     name=name)
+            return ret.fetchone() is not None
+        except Exception:
+            return False
+    finally:
+        connection.close()
+
+def execute_on_own_connection(engine, statement, autocommit=False):
+    """
+    Executes statement on a new connection from engine and commits it.
+    autocommit - run statement outside of transaction, as postgres
+                 requires for CREATE INDEX CONCURRENTLY (psycopg2 only).
+    Returns how long statement took in seconds.
+    """
+    connection = engine.connect()
+    try:
+        started = time.time()
+        if autocommit:
+            # pooled DB-API connection, its isolation level is restored before it goes back to pool
+            dbapi_connection = connection.connection
+            isolation_level = dbapi_connection.isolation_level
+            dbapi_connection.set_isolation_level(0)
+            try:
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute(statement)
+                finally:
+                    cursor.close()
+            finally:
+                dbapi_connection.set_isolation_level(isolation_level)
+        else:
+            transaction = connection.begin()
+            try:
+                connection.execute(statement)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        return time.time() - started
+    finally:
+        connection.close()
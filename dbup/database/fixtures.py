@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import csv
+
+from dbup.compat import json
+from dbup.database.helpers import get_dialect_name
+
+
+BATCH_SIZE = 1000
+# sqlite refuses statements with more bound parameters than that
+MAX_PARAMETERS = 999
+
+
+def guess_format(path):
+    name = path.lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith('.jsonl') or name.endswith('.ndjson') or name.endswith('.json'):
+        return 'jsonl'
+    raise ValueError("Cannot guess format of fixture %s, specify it explicitly" % path)
+
+def none_if_null(value, null):
+    if value == null:
+        return None
+    return value
+
+def iter_csv(f, columns=None, null=''):
+    """
+    Yields (columns, row) for every row of CSV file.
+    If columns are not specified, the first row is taken as a header.
+    Values equal to 'null' are loaded as NULL.
+    """
+    reader = csv.reader(f)
+    if columns is None:
+        columns = reader.next()
+    for row in reader:
+        if null is not None:
+            row = [ none_if_null(value, null) for value in row ]
+        yield columns, row
+
+def iter_jsonl(f, columns=None):
+    """
+    Yields (columns, row) for every line of file with one JSON object per line.
+    If columns are not specified, keys of the first object are used.
+    """
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if columns is None:
+            columns = sorted(record.keys())
+        yield columns, [ record.get(column) for column in columns ]
+
+def choose_method(dialect_name, format):
+    dialect_name = (dialect_name or '').lower()
+    if dialect_name.startswith('postgres') and format == 'csv':
+        return 'copy'
+    if dialect_name in ('mysql', 'sqlite') or dialect_name.startswith('postgres'):
+        return 'values'
+    return 'executemany'
+
+def load_fixture(session, table, path, columns=None, format=None, method=None,
+                 batch_size=BATCH_SIZE, null='', deferred_ddl=None):
+    """
+    Loads rows from CSV or JSON lines file into table.
+    File is read row by row and inserted in batches, so memory use does not depend on its size.
+    Usage from stage:
+        load_fixture(session, 'countries', os.path.join(self.current_path, 'countries.csv'))
+
+    columns - names of columns, by default taken from CSV header or from the first JSON object
+    format - 'csv' or 'jsonl', guessed from file extension by default
+    method - how rows are sent to database:
+        'copy' - COPY FROM STDIN, postgres with psycopg2 and CSV files only
+        'values' - one INSERT with many rows in VALUES per batch
+        'executemany' - one INSERT executed for every row of the batch
+        By default the fastest one supported by the dialect is chosen.
+    null - CSV value to load as NULL
+    deferred_ddl - statements to execute after rows are loaded, e.g. to create indexes
+                   and constraints that would slow down the load.
+    Progress is reported in rows via session.report_progress.
+    Returns number of rows loaded.
+    """
+    if format is None:
+        format = guess_format(path)
+    if method is None:
+        method = choose_method(get_dialect_name(session), format)
+    f = open(path, 'rb')
+    try:
+        if method == 'copy':
+            count = copy_csv(session, table, f, columns, null)
+        else:
+            if format == 'csv':
+                rows = iter_csv(f, columns, null)
+            else:
+                rows = iter_jsonl(f, columns)
+            count = insert_rows(session, table, rows, method, batch_size)
+    finally:
+        f.close()
+    for statement in deferred_ddl or []:
+        session.execute(statement)
+    return count
+
+def insert_rows(session, table, rows, method='executemany', batch_size=BATCH_SIZE):
+    """
+    Inserts (columns, values) pairs yielded by rows into table in batches.
+    Returns number of rows inserted.
+    """
+    count = 0
+    batch = []
+    columns = None
+    for columns, values in rows:
+        batch.append(values)
+        if len(batch) >= batch_size:
+            insert_batch(session, table, columns, batch, method)
+            count += len(batch)
+            batch = []
+            session.report_progress(count, None, 'rows')
+    if batch:
+        insert_batch(session, table, columns, batch, method)
+        count += len(batch)
+        session.report_progress(count, None, 'rows')
+    return count
+
+def insert_batch(session, table, columns, batch, method):
+    column_list = ", ".join(columns)
+    if method == 'executemany':
+        placeholders = ", ".join([ ":c%d" % i for i in range(len(columns)) ])
+        params = [ dict([ ("c%d" % i, value) for i, value in enumerate(values) ]) for values in batch ]
+        session.execute("insert into %s (%s) values (%s)" % (table, column_list, placeholders), params)
+        return
+    if method != 'values':
+        raise ValueError("Unknown method %s" % method)
+    rows_per_statement = max(1, MAX_PARAMETERS // max(1, len(columns)))
+    for start in range(0, len(batch), rows_per_statement):
+        part = batch[start:start + rows_per_statement]
+        groups = []
+        params = {}
+        for row_idx, values in enumerate(part):
+            names = []
+            for col_idx, value in enumerate(values):
+                name = "r%dc%d" % (row_idx, col_idx)
+                params[name] = value
+                names.append(":" + name)
+            groups.append("(%s)" % ", ".join(names))
+        session.execute("insert into %s (%s) values %s" % (table, column_list, ", ".join(groups)), params)
+
+def copy_csv(session, table, f, columns=None, null=''):
+    """
+    Streams CSV file into table with postgres COPY, returns number of rows loaded.
+    """
+    if not session.transaction_active:
+        session.begin()
+    cursor = session.connection.connection.cursor()
+    try:
+        if columns is None:
+            header = "HEADER"
+            column_list = ""
+        else:
+            header = ""
+            column_list = "(%s)" % ", ".join(columns)
+        cursor.copy_expert("COPY %s %s FROM STDIN WITH CSV %s NULL '%s'" % (table, column_list, header,
+                                                                          null.replace("'", "''")),
+                           f)
+        count = cursor.rowcount
+    finally:
+        cursor.close()
+    session.report_progress(count, count, 'rows')
+    return count
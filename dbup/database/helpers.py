@@ -24,13 +24,330 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-def exec_sql_file(session, path):
+import os
+import re
+
+
+CHUNK_SIZE = 1024 * 1024
+
+re_dollar_tag = re.compile(r'\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$')
+re_dollar_prefix = re.compile(r'\$[A-Za-z_0-9]*$')
+re_word = re.compile(r'[A-Za-z_][A-Za-z_0-9]*')
+re_word_tail = re.compile(r'[A-Za-z_0-9]+$')
+
+# statements that have a body with semicolons inside BEGIN ... END
+COMPOUND_OBJECTS = frozenset(['TRIGGER', 'PROCEDURE', 'FUNCTION', 'EVENT', 'PACKAGE'])
+# objects that are known to have no such body, so there is no need to look further
+SIMPLE_OBJECTS = frozenset(['TABLE', 'INDEX', 'VIEW', 'SEQUENCE', 'SCHEMA', 'DATABASE',
+                            'UNIQUE', 'USER', 'ROLE'])
+# END followed by these closes a block that was not counted when opened
+UNCOUNTED_ENDS = frozenset(['IF', 'LOOP', 'WHILE', 'REPEAT'])
+
+
+class SqlSplitter(object):
+    """
+    Splits SQL script into separate statements by semicolons, skipping semicolons
+    that appear inside quotes, comments and $tag$ quoted strings, as well as
+    inside BEGIN ... END bodies of CREATE TRIGGER/PROCEDURE/FUNCTION statements.
+    Text is fed in pieces of any size, complete statements are returned
+    as soon as they are seen, so the whole script never has to be in memory.
+    """
+    NORMAL, QUOTED, LINE_COMMENT, BLOCK_COMMENT, DOLLAR_QUOTED = range(5)
+
+    def __init__(self, dollar_quoting=False, backslash_escapes=False, quotes='\'"'):
+        """
+        dollar_quoting - treat $tag$...$tag$ as string literal (postgres)
+        backslash_escapes - backslash escapes next character inside quotes (mysql)
+        quotes - characters that open quoted strings and identifiers
+        """
+        self.dollar_quoting = dollar_quoting
+        self.backslash_escapes = backslash_escapes
+        self.quotes = quotes
+        specials = quotes + ';-/'
+        if dollar_quoting:
+            specials += '$'
+        self.re_special = re.compile('[%s]' % re.escape(specials))
+        self.buffer = ''
+        self.pos = 0
+        self.state = self.NORMAL
+        self.closing = None # closing quote or dollar tag
+        self.has_content = False
+        self.__reset_statement()
+
+    def __reset_statement(self):
+        # whether statement has BEGIN ... END body, None until its first words tell
+        self.compound = None
+        self.head_words = 0
+        # how many BEGIN (or CASE) are not closed by END yet
+        self.depth = 0
+        # END was seen, the next word tells whether it closes counted block
+        self.pending_end = False
+
+    def feed(self, text):
+        """
+        Adds text to the script, returns list of statements completed by it.
+        """
+        self.buffer += text
+        return self.__split(False)
+
+    def close(self):
+        """
+        Returns list with the last statement if script doesn't end with semicolon.
+        """
+        statements = self.__split(True)
+        if self.has_content and self.buffer.strip():
+            statements.append(self.buffer.strip())
+        self.buffer = ''
+        self.pos = 0
+        self.has_content = False
+        self.__reset_statement()
+        return statements
+
+    def __scan_words(self, text):
+        for m in re_word.finditer(text):
+            word = m.group(0).upper()
+            if self.compound is None:
+                self.head_words += 1
+                if self.head_words == 1:
+                    if word != 'CREATE':
+                        self.compound = False
+                elif word in COMPOUND_OBJECTS:
+                    self.compound = True
+                elif word in SIMPLE_OBJECTS or self.head_words > 10:
+                    self.compound = False
+                if self.compound is False:
+                    return
+                if self.compound is None:
+                    continue
+            if self.pending_end:
+                self.pending_end = False
+                if word in UNCOUNTED_ENDS:
+                    continue
+                self.depth -= 1
+                if word == 'CASE': # END CASE
+                    continue
+            if word == 'END':
+                self.pending_end = True
+            elif word in ('BEGIN', 'CASE'):
+                self.depth += 1
+
+    def __split(self, final):
+        statements = []
+        buf = self.buffer
+        pos = self.pos
+        length = len(buf)
+        # where current statement starts, buffer is only cut once at the end,
+        # cutting it after every statement would copy the rest of it every time
+        start = 0
+        while pos < length:
+            state = self.state
+            if state == self.NORMAL:
+                m = self.re_special.search(buf, pos)
+                if m is None:
+                    end = length
+                    if not final:
+                        # word may continue in the next piece
+                        tail = re_word_tail.search(buf, pos)
+                        if tail is not None:
+                            end = tail.start()
+                else:
+                    end = m.start()
+                if not self.has_content and buf[pos:end].strip():
+                    self.has_content = True
+                if self.compound is None and not self.head_words:
+                    # most statements are told apart by their first word alone
+                    first = re_word.search(buf, pos, end)
+                    if first is not None and first.group(0).upper() != 'CREATE':
+                        self.compound = False
+                if self.compound is not False:
+                    self.__scan_words(buf[pos:end])
+                if m is None:
+                    pos = end
+                    break
+                pos = end
+                char = buf[pos]
+                if char == ';':
+                    if self.pending_end:
+                        self.pending_end = False
+                        self.depth -= 1
+                    if self.depth > 0:
+                        # semicolon inside BEGIN ... END body
+                        pos += 1
+                        continue
+                    if self.has_content:
+                        statements.append(buf[start:pos].strip())
+                    pos += 1
+                    start = pos
+                    self.has_content = False
+                    # depth is 0 and no END is pending here
+                    self.compound = None
+                    self.head_words = 0
+                elif char in self.quotes:
+                    self.state = self.QUOTED
+                    self.closing = char
+                    self.has_content = True
+                    pos += 1
+                elif char in '-/':
+                    if pos + 1 >= length and not final:
+                        break # need next character to decide
+                    following = buf[pos+1:pos+2]
+                    if char == '-' and following == '-':
+                        self.state = self.LINE_COMMENT
+                        pos += 2
+                    elif char == '/' and following == '*':
+                        self.state = self.BLOCK_COMMENT
+                        pos += 2
+                    else:
+                        self.has_content = True
+                        pos += 1
+                else: # dollar sign
+                    m = re_dollar_tag.match(buf, pos)
+                    if m is not None:
+                        self.state = self.DOLLAR_QUOTED
+                        self.closing = m.group(0)
+                        self.has_content = True
+                        pos = m.end()
+                    elif not final and re_dollar_prefix.match(buf, pos):
+                        break # tag may continue in the next piece
+                    else:
+                        self.has_content = True
+                        pos += 1
+            elif state == self.QUOTED:
+                end = buf.find(self.closing, pos)
+                if self.backslash_escapes:
+                    escape = buf.find('\\', pos)
+                    if escape != -1 and (end == -1 or escape < end):
+                        if escape + 1 >= length and not final:
+                            pos = escape
+                            break
+                        pos = escape + 2
+                        continue
+                if end == -1:
+                    pos = length
+                    break
+                # doubled quote just closes and opens the string again
+                self.state = self.NORMAL
+                pos = end + 1
+            elif state == self.LINE_COMMENT:
+                end = buf.find('\n', pos)
+                if end == -1:
+                    pos = length
+                    break
+                self.state = self.NORMAL
+                pos = end + 1
+            elif state == self.BLOCK_COMMENT:
+                end = buf.find('*/', pos)
+                if end == -1:
+                    pos = max(pos, length - 1)
+                    break
+                self.state = self.NORMAL
+                pos = end + 2
+            else: # dollar quoted
+                end = buf.find(self.closing, pos)
+                if end == -1:
+                    pos = max(pos, length - len(self.closing) + 1)
+                    break
+                self.state = self.NORMAL
+                pos = end + len(self.closing)
+        self.buffer = buf[start:]
+        self.pos = pos - start
+        return statements
+
+
+def get_splitter(dialect_name=None):
+    """
+    Returns SqlSplitter configured for dialect name specified (as in sqlalchemy dialect.name).
+    """
+    dialect_name = (dialect_name or '').lower()
+    if dialect_name.startswith('postgres'):
+        return SqlSplitter(dollar_quoting=True)
+    if dialect_name == 'mysql':
+        return SqlSplitter(backslash_escapes=True, quotes='\'"`')
+    return SqlSplitter()
+
+def iter_sql_statements(f, dialect_name=None, chunk_size=CHUNK_SIZE):
+    """
+    Reads SQL script from file object 'f' piece by piece
+    and yields statements it consists of.
+    """
+    splitter = get_splitter(dialect_name)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        for statement in splitter.feed(chunk):
+            yield statement
+    for statement in splitter.close():
+        yield statement
+
+def exec_sql_file(session, path, batch_size=1, dialect_name=None, chunk_size=CHUNK_SIZE):
     """
     Load SQL from file, specified by 'path' argument,
     and execute it via 'execute' function of 'session' specified.
-    Returns value returned by 'session.execute'
+    File is read and split into statements incrementally, so it can be of any size.
+    batch_size - how many statements to send to database at once,
+                 values above 1 require driver that supports several statements per call.
+    dialect_name - how to split statements, taken from the session connection if not specified.
+    Progress is reported in bytes via session.report_progress.
+    Returns value returned by the last 'session.execute'
     """
+    if dialect_name is None:
+        dialect_name = get_dialect_name(session)
+    total = os.path.getsize(path)
+    result = None
+    batch = []
+    reported = 0
     f = open(path, 'r')
-    sql = f.read()
-    f.close()
-    return session.execute(sql)
+    try:
+        for statement in iter_sql_statements(f, dialect_name, chunk_size):
+            if batch_size > 1 and '--' in statement.splitlines()[-1]:
+                # semicolon joining batch must not end up in a trailing comment
+                statement += "\n"
+            batch.append(statement)
+            if len(batch) >= batch_size:
+                result = session.execute(";\n".join(batch))
+                batch = []
+                # report once per chunk read rather than once per statement
+                done = f.tell()
+                if done != reported:
+                    session.report_progress(done, total, 'bytes')
+                    reported = done
+        if batch:
+            result = session.execute(";\n".join(batch))
+        session.report_progress(total, total, 'bytes')
+    finally:
+        f.close()
+    return result
+
+def get_dialect_name(session):
+    """
+    Returns name of sqlalchemy dialect session is connected with, or None.
+    """
+    try:
+        # engine.name works with sqlalchemy 0.4 too, dialect.name does not
+        return session.connection.engine.name
+    except AttributeError:
+        return None
+
+def has_table(session, table):
+    """
+    Returns True if table exists, as seen by session's connection, so it also
+    sees tables created earlier in the same transaction.
+    """
+    if get_dialect_name(session) == 'sqlite':
+        # has_table of sqlite dialect in sqlalchemy 0.4 fails with recent pysqlite
+        ret = session.execute("select count(*) from sqlite_master where type = 'table' and name = :name",
+                              {'name': table})
+        return ret.fetchone()[0] > 0
+    connection = session.connection
+    return connection.engine.dialect.has_table(connection, table)
+
+def connection_has_table(connection, table):
+    """
+    Same as has_table, for a plain sqlalchemy connection.
+    """
+    if connection.engine.name == 'sqlite':
+        ret = connection.execute("select count(*) from sqlite_master where type = 'table' and name = :name",
+                                 {'name': table})
+        return ret.fetchone()[0] > 0
+    return connection.engine.dialect.has_table(connection, table)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import time
+import zlib
+import socket
+import random
+import datetime
+
+
+class LockTimeout(Exception):
+    def __init__(self, name=None, timeout=None):
+        Exception.__init__(self, "Could not acquire lock \"%s\" in %s seconds" % (name, timeout))
+        self.name = name
+        self.timeout = timeout
+
+
+class MigrationLock(object):
+    """
+    Lock held in database, so only one of many processes (or hosts) migrates it at a time.
+    Uses advisory locks on postgres and mysql, a row in lock_table elsewhere.
+    Lock is held on a connection of its own, separate from the one migration runs on.
+    Usage:
+        lock = MigrationLock(backend)
+        lock.acquire()
+        try:
+            ...
+        finally:
+            lock.release()
+    """
+    def __init__(self, backend, name='dbup', timeout=600, lock_table='dbup_lock',
+                 stale_after=None, initial_delay=0.1, max_delay=5.0):
+        """
+        timeout - seconds to wait for the lock before giving up with LockTimeout, None waits forever
+        stale_after - seconds after which a row in lock_table is considered abandoned by
+                      crashed process and removed. Advisory locks are released by database
+                      when connection is lost, so it is not used for them.
+        initial_delay, max_delay - waiting starts with initial_delay seconds between attempts
+                      and doubles up to max_delay, with some jitter, so waiting hosts do not
+                      hit database all at the same moment.
+        """
+        self.backend = backend
+        self.name = name
+        self.timeout = timeout
+        self.lock_table = lock_table
+        self.stale_after = stale_after
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.connection = None
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def acquire(self):
+        self.connection = self.backend.open_connection()
+        dialect_name = self.connection.engine.name.lower()
+        if dialect_name.startswith('postgres'):
+            self.method = 'postgres'
+        elif dialect_name == 'mysql':
+            self.method = 'mysql'
+        else:
+            self.method = 'table'
+            self.__setup_table()
+        started = time.time()
+        delay = self.initial_delay
+        try:
+            while not self.__try_acquire():
+                if self.timeout is not None and time.time() - started >= self.timeout:
+                    raise LockTimeout(name=self.name, timeout=self.timeout)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, self.max_delay)
+        except:
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def release(self):
+        if self.connection is None:
+            return
+        try:
+            if self.method == 'postgres':
+                self.__scalar("select pg_advisory_unlock(%d)" % self.__key())
+            elif self.method == 'mysql':
+                self.__scalar("select release_lock('%s')" % self.name)
+            else:
+                self.__execute("delete from %s where name = '%s' and owner = '%s'"
+                               % (self.lock_table, self.name, self.owner))
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def __try_acquire(self):
+        if self.method == 'postgres':
+            return bool(self.__scalar("select pg_try_advisory_lock(%d)" % self.__key()))
+        if self.method == 'mysql':
+            return self.__scalar("select get_lock('%s', 0)" % self.name) == 1
+        try:
+            if self.stale_after is not None:
+                stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.stale_after)
+                self.__execute("delete from %s where name = '%s' and acquired_at < '%s'"
+                               % (self.lock_table, self.name, stale.strftime('%Y-%m-%d %H:%M:%S')))
+            self.__execute("insert into %s values ('%s', '%s', '%s')"
+                           % (self.lock_table, self.name, self.owner,
+                              datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+            return True
+        except Exception:
+            # row is there already, somebody else holds the lock,
+            # or database is busy with their migration (sqlite), try again later
+            return False
+
+    def __key(self):
+        # advisory locks take number, not name
+        return zlib.crc32(self.name) & 0x7fffffff
+
+    def __scalar(self, statement):
+        return self.connection.execute(statement).scalar()
+
+    def __execute(self, statement):
+        transaction = self.connection.begin()
+        try:
+            self.connection.execute(statement)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+
+    def __setup_table(self):
+        try:
+            self.__execute("create table %s (name varchar(100) primary key, owner varchar(255), "
+                           "acquired_at timestamp);" % self.lock_table)
+        except Exception:
+            pass # created already
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import re
+import time
+import threading
+
+
+re_whitespace = re.compile(r'\s+')
+re_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+re_in_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+# upper bounds of histogram buckets, in seconds
+HISTOGRAM_BOUNDS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0, None)
+
+
+def normalize(expression):
+    """
+    Returns statement text with literals replaced by '?' and whitespace collapsed,
+    so the same statement with different values is counted as one.
+    """
+    if not isinstance(expression, basestring):
+        expression = str(expression)
+    text = re_whitespace.sub(' ', expression).strip()
+    text = re_literals.sub('?', text)
+    return re_in_lists.sub('(...)', text)
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1000)
+    return "%.2fs" % seconds
+
+
+class StatementStats(object):
+    def __init__(self, stage, text):
+        self.stage = stage
+        self.text = text
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+
+    def add(self, seconds, rowcount):
+        self.count += 1
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+        if rowcount > 0:
+            self.rows += rowcount
+
+
+class StatementProfiler(object):
+    """
+    Collects latency and rowcount of statements executed through sessions it is given to.
+    Statements are grouped by their normalized text and the stage that issued them.
+    Usage:
+        profiler = StatementProfiler()
+        worker = SqlWorker(connection_string, profiler=profiler)
+        ...
+        print profiler.report(top=20)
+    One profiler may be shared by sessions working in different threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.histogram = [0] * len(HISTOGRAM_BOUNDS)
+        self.count = 0
+        self.total_time = 0.0
+
+    def record(self, stage, expression, seconds, rowcount):
+        text = normalize(expression)
+        self.lock.acquire()
+        try:
+            key = (stage, text)
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats(stage, text)
+            stats.add(seconds, rowcount)
+            for i, bound in enumerate(HISTOGRAM_BOUNDS):
+                if bound is None or seconds <= bound:
+                    self.histogram[i] += 1
+                    break
+            self.count += 1
+            self.total_time += seconds
+        finally:
+            self.lock.release()
+
+    def get_slowest(self, top=20):
+        """
+        Returns StatementStats of 'top' statements that took most time in total.
+        """
+        self.lock.acquire()
+        try:
+            statements = self.statements.values()
+        finally:
+            self.lock.release()
+        statements.sort(key=lambda stats: stats.total_time, reverse=True)
+        return statements[:top]
+
+    def report(self, top=20, width=100):
+        """
+        Returns text with 'top' slowest statements and histogram of statement latencies.
+        """
+        lines = ["Statements: %d, total time: %s." % (self.count, format_seconds(self.total_time))]
+        lines.append("")
+        lines.append("%-10s %9s %9s %9s %9s  %s" % ('stage', 'total', 'max', 'calls', 'rows', 'statement'))
+        for stats in self.get_slowest(top):
+            text = stats.text
+            if len(text) > width:
+                text = text[:width - 3] + '...'
+            lines.append("%-10s %9s %9s %9d %9d  %s" % (stats.stage or '(dbup)',
+                                                        format_seconds(stats.total_time),
+                                                        format_seconds(stats.max_time),
+                                                        stats.count, stats.rows, text))
+        lines.append("")
+        lines.append("Latency histogram:")
+        largest = max(self.histogram) or 1
+        lower = "0"
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.histogram):
+            if bound is None:
+                label = "> %s" % lower
+            else:
+                label = "%s - %s" % (lower, format_seconds(bound))
+                lower = format_seconds(bound)
+            lines.append(("%-18s %9d %s" % (label, count, '#' * (40 * count // largest))).rstrip())
+        return "\n".join(lines)
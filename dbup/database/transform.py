@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+
+from dbup.database.backfill import PROGRESS_TABLE, setup_progress_table, get_last_key, save_last_key
+
+
+def transform_rows(session, table, key, columns, func, target_columns=None, batch_size=1000,
+                   where=None, pool=None, window=None, name=None, method='keyset',
+                   progress_table=PROGRESS_TABLE):
+    """
+    Reads rows of table in batches, passes every batch to func and writes what it
+    returns back with executemany, so only a few batches are in memory at a time
+    no matter how large the table is. Usage from stage:
+        def split_names(rows):
+            return [ (id, ) + tuple(full_name.split(' ', 1)) for id, full_name in rows ]
+        transform_rows(session, 'users', 'id', ['full_name'], split_names,
+                       target_columns=['first_name', 'last_name'])
+
+    columns - columns to read, func gets list of (key, column1, column2...) tuples
+    func - returns list of (key, value1, value2...) tuples for target_columns,
+           rows it leaves out are not updated
+    target_columns - columns to write, the same as columns by default
+    where - SQL condition to select rows by, without parameters
+    pool - e.g. multiprocessing.Pool for CPU-heavy func, or multiprocessing.dummy.Pool
+           if func mostly waits for something. func must be a module-level function
+           for process pools. By default batches are transformed right here.
+    window - how many batches may be in pool at the same time, twice as many as
+             pool has processes by default
+    method - 'keyset' reads every batch with a query after the last key of the previous
+             one and commits after every batch. Progress is remembered under 'name'
+             (table.key by default) like backfill does, so interrupted transform
+             continues where it stopped.
+             'cursor' reads all rows with one query through a server-side cursor,
+             in one transaction, postgres with psycopg2 only.
+    Progress is reported in rows via session.report_progress.
+    Returns number of rows read.
+    """
+    if target_columns is None:
+        target_columns = columns
+    if method == 'keyset':
+        if name is None:
+            name = "%s.%s" % (table, key)
+        setup_progress_table(session, progress_table)
+        batches = iter_keyset_batches(session, table, key, columns, batch_size, where,
+                                      get_last_key(session, progress_table, name))
+    elif method == 'cursor':
+        batches = iter_cursor_batches(session, table, key, columns, batch_size, where)
+    else:
+        raise ValueError("Unknown method %s" % method)
+    update = "update %s set %s where %s = :k" % (table,
+                                                 ", ".join([ "%s = :v%d" % (column, i)
+                                                             for i, column in enumerate(target_columns) ]),
+                                                 key)
+    counts = {'processed': 0}
+    def write(last_key, count, rows):
+        if rows:
+            params = [ dict([ ('k', row[0]) ] + [ ("v%d" % i, value) for i, value in enumerate(row[1:]) ])
+                       for row in rows ]
+            session.execute(update, params)
+        if method == 'keyset':
+            save_last_key(session, progress_table, name, last_key)
+            session.commit()
+        counts['processed'] += count
+        session.report_progress(counts['processed'], None, 'rows')
+
+    if pool is None:
+        for batch in batches:
+            write(batch[-1][0], len(batch), func(batch))
+    else:
+        if window is None:
+            window = 2 * max(1, len(getattr(pool, '_pool', [])))
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch[-1][0], len(batch), pool.apply_async(func, (batch, ))))
+            if len(pending) >= window:
+                last_key, count, result = pending.popleft()
+                write(last_key, count, result.get())
+        while pending:
+            last_key, count, result = pending.popleft()
+            write(last_key, count, result.get())
+    if method == 'keyset':
+        # done, next transform with the same name starts from scratch
+        session.execute("delete from %s where name = :name" % progress_table, {'name': name})
+    session.commit()
+    return counts['processed']
+
+def iter_keyset_batches(session, table, key, columns, batch_size, where=None, last_key=None):
+    """
+    Yields lists of (key, column1, column2...) tuples ordered by key, batch_size rows each.
+    Every batch is read with its own query starting after the last key of previous batch.
+    """
+    select = "select %s from %s" % (", ".join([key] + list(columns)), table)
+    conditions = []
+    if where:
+        conditions.append("(%s)" % where)
+    while True:
+        if last_key is None:
+            ret = session.execute("%s%s order by %s limit %d" % (select, get_where(conditions), key, batch_size))
+        else:
+            ret = session.execute("%s%s order by %s limit %d" % (select,
+                                                                 get_where(conditions + ["%s > :last" % key]),
+                                                                 key, batch_size),
+                                  {'last': last_key})
+        batch = [ tuple(row) for row in ret.fetchall() ]
+        if not batch:
+            return
+        yield batch
+        last_key = batch[-1][0]
+
+def iter_cursor_batches(session, table, key, columns, batch_size, where=None):
+    """
+    Yields lists of (key, column1, column2...) tuples ordered by key, batch_size rows each.
+    Rows are read by one query through a named (server-side) psycopg2 cursor.
+    """
+    if not session.transaction_active:
+        session.begin()
+    conditions = []
+    if where:
+        conditions.append("(%s)" % where)
+    cursor = session.connection.connection.cursor('dbup_transform')
+    try:
+        cursor.execute("select %s from %s%s order by %s" % (", ".join([key] + list(columns)), table,
+                                                            get_where(conditions), key))
+        while True:
+            batch = [ tuple(row) for row in cursor.fetchmany(batch_size) ]
+            if not batch:
+                return
+            yield batch
+    finally:
+        cursor.close()
+
+def get_where(conditions):
+    if not conditions:
+        return ""
+    return " where %s" % " and ".join(conditions)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import re
+import threading
+import Queue
+
+from dbup.manager import Manager, NothingToDo, UnavailableVersion
+from dbup.worker import SqlWorker, NoInstallation
+from dbup.database.backend import Backend
+from dbup.version_catalog import CachedVersionCatalog
+
+
+re_password = re.compile(r'(?P<prefix>://[^:/@]*:)[^@]*@')
+
+def hide_password(connection_string):
+    """
+    Returns connection string with password replaced by asterisks, suitable for output.
+    """
+    return re_password.sub(r'\g<prefix>***@', connection_string)
+
+def read_targets(path):
+    """
+    Reads connection strings from file specified by 'path', one per line.
+    Empty lines and lines starting with '#' are skipped.
+    """
+    f = open(path, 'r')
+    try:
+        lines = [ line.strip() for line in f ]
+    finally:
+        f.close()
+    return [ line for line in lines if line and not line.startswith('#') ]
+
+def default_worker_factory(connection_string):
+    return SqlWorker(backend=Backend(connection_string))
+
+
+class TargetResult(object):
+    """
+    Outcome of running an action against one target.
+    """
+    def __init__(self, target, ok=True, version=None, message='', error=None):
+        self.target = target
+        self.ok = ok
+        self.version = version
+        self.message = message
+        self.error = error
+
+    def __str__(self):
+        if self.ok:
+            status = "OK"
+        else:
+            status = "FAILED"
+        return "%s: %s, %s" % (hide_password(self.target), status, self.message)
+
+
+class FleetManager(object):
+    """
+    Runs the same action against many databases using a bounded pool of threads.
+    Catalog is scanned and every stage is loaded only once, all targets share them.
+    Failure on one target does not affect the others, every target gets its own TargetResult.
+    """
+    def __init__(self, targets, catalog=None, worker_factory=default_worker_factory, jobs=4,
+                 sort_key=None, lock_factory=None, prefetch=0):
+        """
+        targets - list of connection strings
+        worker_factory - callable that creates worker for a connection string
+        jobs - how many targets are processed at the same time
+        sort_key - how to order versions, see dbup.manager.Planner
+        lock_factory - callable that creates lock for a worker, see Manager, no locks if None
+        prefetch - how many stages to load ahead on every target, see Manager
+        """
+        self.targets = targets
+        self.sort_key = sort_key
+        self.catalog = CachedVersionCatalog(catalog)
+        self.worker_factory = worker_factory
+        self.lock_factory = lock_factory
+        self.prefetch = prefetch
+        self.jobs = max(1, jobs)
+
+    def upgrade(self, to_version=None):
+        return self.run(self.__upgrade_target, to_version)
+
+    def downgrade(self, to_version):
+        return self.run(self.__downgrade_target, to_version)
+
+    def status(self):
+        return self.run(self.__status_target)
+
+    def verify(self):
+        return self.run(self.__verify_target)
+
+    def plan_upgrade(self, to_version=None):
+        return self.run(self.__plan_target, lambda manager: manager.plan_upgrade(to_version))
+
+    def plan_downgrade(self, to_version):
+        return self.run(self.__plan_target, lambda manager: manager.plan_downgrade(to_version))
+
+    def run(self, action, *args):
+        """
+        Calls action(target, manager, *args) for every target.
+        Returns list of TargetResult in the same order as targets.
+        """
+        results = [None] * len(self.targets)
+        queue = Queue.Queue()
+        for idx, target in enumerate(self.targets):
+            queue.put((idx, target))
+        def consume():
+            while True:
+                try:
+                    idx, target = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[idx] = self.__run_target(action, target, *args)
+        threads = [ threading.Thread(target=consume) for _ in range(min(self.jobs, len(self.targets))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def __run_target(self, action, target, *args):
+        worker = None
+        try:
+            try:
+                worker = self.worker_factory(target)
+                lock = None
+                if self.lock_factory is not None:
+                    lock = self.lock_factory(worker)
+                manager = Manager(worker=worker, catalog=self.catalog, sort_key=self.sort_key,
+                                  prefetch=self.prefetch, lock=lock)
+                return action(target, manager, *args)
+            except Exception, e:
+                return TargetResult(target, ok=False, message="%s: %s" % (e.__class__.__name__, e), error=e)
+        finally:
+            # do not keep hundreds of connections open until the whole fleet is done
+            backend = getattr(worker, 'backend', None)
+            if backend is not None:
+                try:
+                    backend.disconnect()
+                    if getattr(backend, 'owns_engine', False) and backend.engine is not None:
+                        backend.engine.dispose()
+                except Exception:
+                    pass
+
+    def __upgrade_target(self, target, manager, to_version):
+        try:
+            manager.upgrade(to_version)
+        except NothingToDo, e:
+            if e.current_version == e.to_version:
+                return TargetResult(target, version=e.current_version,
+                                    message="already up to date (version \"%s\")" % e.current_version)
+            return TargetResult(target, ok=False, version=e.current_version, error=e,
+                                message="cannot upgrade from \"%s\" to \"%s\"" % (e.current_version, e.to_version))
+        except UnavailableVersion, e:
+            if e.is_installed():
+                return TargetResult(target, ok=False, version=e.version, error=e,
+                                    message="installed version \"%s\" is not in catalog" % e.version)
+            return TargetResult(target, ok=False, error=e,
+                                message="version \"%s\" is not available" % e.version)
+        if to_version is None:
+            to_version = manager.planner.get_versions()[0][-1]
+        return TargetResult(target, version=to_version, message="upgraded to \"%s\"" % to_version)
+
+    def __downgrade_target(self, target, manager, to_version):
+        try:
+            manager.downgrade(to_version)
+        except NoInstallation, e:
+            return TargetResult(target, ok=False, error=e, message="no installation detected")
+        except NothingToDo, e:
+            if e.current_version == e.to_version:
+                return TargetResult(target, version=e.current_version,
+                                    message="already at version \"%s\"" % e.current_version)
+            return TargetResult(target, ok=False, version=e.current_version, error=e,
+                                message="cannot downgrade from \"%s\" to \"%s\"" % (e.current_version, e.to_version))
+        except UnavailableVersion, e:
+            if e.is_installed():
+                return TargetResult(target, ok=False, version=e.version, error=e,
+                                    message="installed version \"%s\" is not in catalog" % e.version)
+            return TargetResult(target, ok=False, error=e,
+                                message="version \"%s\" is not available" % e.version)
+        return TargetResult(target, version=to_version, message="downgraded to \"%s\"" % to_version)
+
+    def __plan_target(self, target, manager, make_plan):
+        try:
+            plan = make_plan(manager)
+        except NoInstallation, e:
+            return TargetResult(target, ok=False, error=e, message="no installation detected")
+        except NothingToDo, e:
+            if e.current_version == e.to_version:
+                return TargetResult(target, version=e.current_version,
+                                    message="already at version \"%s\"" % e.current_version)
+            return TargetResult(target, ok=False, version=e.current_version, error=e,
+                                message="cannot go from \"%s\" to \"%s\"" % (e.current_version, e.to_version))
+        except UnavailableVersion, e:
+            if e.is_installed():
+                return TargetResult(target, ok=False, version=e.version, error=e,
+                                    message="installed version \"%s\" is not in catalog" % e.version)
+            return TargetResult(target, ok=False, error=e,
+                                message="version \"%s\" is not available" % e.version)
+        return TargetResult(target, version=plan.current_version, message=str(plan))
+
+    def __status_target(self, target, manager):
+        try:
+            version = manager.worker.get_current_version()
+        except NoInstallation:
+            return TargetResult(target, message="no installation detected")
+        return TargetResult(target, version=version, message="version \"%s\"" % version)
+
+    def __verify_target(self, target, manager):
+        drifted = manager.verify()
+        if drifted:
+            return TargetResult(target, ok=False,
+                                message="changed since applied: %s" % ", ".join([ d[0] for d in drifted ]))
+        return TargetResult(target, message="no changes")
@@ -22,6 +22,13 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
+import re
+import sys
+import itertools
+import threading
+import Queue
+
+from dbup import events
 from dbup.worker import NoInstallation
 
 
@@ -38,100 +45,383 @@ class NothingToDo(Exception):
 
 
 class UnavailableVersion(Exception):
-    def __init__(self, version=None, all_versions=None):
+    def __init__(self, version=None, all_versions=None, current_version=None):
         self.version = version
         self.all_versions = all_versions
+        self.current_version = current_version
+
+    def is_installed(self):
+        """
+        True when it is the installed version that has gone from catalog.
+        """
+        return self.current_version is not None and self.version == self.current_version
 
 
-class Manager(object):
-    def __init__(self, worker=None, catalog=None):
+def iter_stages(catalog, versions, prefetch=0):
+    """
+    Yields (version name, initialized stage object) for every version,
+    stages are loaded from catalog only when they are needed.
+    If prefetch is positive, up to that many stages are loaded ahead
+    in a background thread while the current one is being executed.
+    """
+    if prefetch <= 0:
+        for version in versions:
+            yield version, catalog.load_stage(version)
+        return
+    queue = Queue.Queue(prefetch)
+    stopped = threading.Event()
+    def put(item):
+        while not stopped.isSet():
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for version in versions:
+                if not put((version, catalog.load_stage(version), None)):
+                    return
+        except:
+            put((None, None, sys.exc_info()))
+            return
+        put(None)
+    loader = threading.Thread(target=produce)
+    loader.setDaemon(True)
+    loader.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            version, stage, exc_info = item
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield version, stage
+    finally:
+        stopped.set()
+
+
+re_number = re.compile(r'(\d+)')
+
+def natural_key(version):
+    """
+    Sort key that compares numeric parts of versions as numbers,
+    so "2" goes before "10" and "1.9" before "1.10".
+    """
+    parts = re_number.split(version)
+    for idx in range(1, len(parts), 2):
+        parts[idx] = int(parts[idx])
+    return parts
+
+
+class Plan(object):
+    """
+    What has to be done to bring database from current_version to to_version.
+    versions - list of versions in the order worker expects them:
+      upgrade - versions to apply, oldest first
+      downgrade - versions to revert, newest first, ending with to_version, which is not reverted
+      uninstall - versions to revert, newest first
+    baseline - squashed baseline to apply before versions on fresh installation, or None
+    Plan may be printed, serialized with to_dict and executed later with Manager.execute.
+    """
+    UPGRADE = 'upgrade'
+    DOWNGRADE = 'downgrade'
+    UNINSTALL = 'uninstall'
+
+    def __init__(self, action, current_version, to_version, versions, baseline=None):
+        self.action = action
+        self.current_version = current_version
+        self.to_version = to_version
+        self.versions = versions
+        self.baseline = baseline
+
+    def get_executed_versions(self):
         """
-        You ask this class to upgrade/downgrade/etc your databases.
+        Returns versions whose stages are actually run, in order.
+        """
+        versions = list(self.versions)
+        if self.action == self.DOWNGRADE:
+            versions = versions[:-1]
+        if self.baseline is not None:
+            versions.insert(0, self.baseline)
+        return versions
+
+    def to_dict(self):
+        return {'action': self.action,
+                'current_version': self.current_version,
+                'to_version': self.to_version,
+                'versions': list(self.versions),
+                'baseline': self.baseline}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['action'], data['current_version'], data['to_version'],
+                   list(data['versions']), data.get('baseline'))
+
+    def __eq__(self, other):
+        return isinstance(other, Plan) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        if self.action == self.UNINSTALL:
+            lines = ["Uninstall version \"%s\"." % self.current_version]
+        else:
+            lines = ["%s from \"%s\" to \"%s\"." % (self.action.capitalize(),
+                                                   self.current_version or "no installation",
+                                                   self.to_version)]
+        if self.baseline is not None:
+            lines.append("  baseline %s" % self.baseline)
+        for version in self.get_executed_versions():
+            if version != self.baseline:
+                lines.append("  %s %s" % (self.action == self.UPGRADE and "up" or "down", version))
+        return "\n".join(lines)
+
+
+class Planner(object):
+    """
+    Works out plans from the list of available versions.
+    Position of every version is indexed once per catalog snapshot,
+    so planning does not scan the whole list for every lookup.
+    """
+    def __init__(self, catalog, sort_key=None):
+        """
+        sort_key - key to order versions by, e.g. natural_key.
+                   By default order given by catalog is used.
         """
-        self.worker = worker
         self.catalog = catalog
+        self.sort_key = sort_key
+        self.snapshot = None
+        self.versions = None
+        self.index = None
 
-    def upgrade(self, to_version):
-        try:
-            current_version = self.worker.get_current_version()
-        except NoInstallation:
-            current_version = None
-        available_versions = self.catalog.get_available_versions()
+    def get_versions(self):
+        """
+        Returns ordered list of available versions and dictionary of version => position.
+        """
+        snapshot = self.catalog.get_available_versions()
+        if snapshot != self.snapshot:
+            versions = list(snapshot)
+            if self.sort_key is not None:
+                versions.sort(key=self.sort_key)
+            self.index = dict([ (version, idx) for idx, version in enumerate(versions) ])
+            self.versions = versions
+            self.snapshot = snapshot
+        return self.versions, self.index
 
+    def plan_upgrade(self, current_version, to_version=None):
+        versions, index = self.get_versions()
         # if destination version is not specified, use latest available
         if to_version is None:
-            to_version = available_versions[-1]
-
+            to_version = versions[-1]
         # check if we need upgrade at all
         if current_version == to_version:
             raise NothingToDo(current_version=current_version,
                               to_version=to_version,
                               action=NothingToDo.ACTION.upgrade)
-        if current_version is not None:
-            if available_versions.index(to_version) < available_versions.index(current_version):
-                raise NothingToDo(current_version=current_version,
-                                  to_version=to_version,
-                                  action=NothingToDo.ACTION.upgrade)
-
-        # ok, upgrading
-        stages = []
-        if current_version in available_versions:
-            current_version_idx = available_versions.index(current_version)
-        else:
-            current_version_idx = -1
-        # check whether requested version is available or not
-        if to_version not in available_versions:
+        # check whether requested and installed versions are available or not
+        if to_version not in index:
             raise UnavailableVersion(version=to_version,
-                                     all_versions=available_versions)
-        to_version_idx = available_versions.index(to_version)
-        needed_versions = available_versions[current_version_idx+1: to_version_idx+1]
-        # build list of stages, where every list item is (version name, initialized stage object)
-        stages = [ (version, self.catalog.load_stage(version)) for version in needed_versions ]
-        self.worker.upgrade(stages)
+                                     all_versions=versions,
+                                     current_version=current_version)
+        if current_version is not None and current_version not in index:
+            raise UnavailableVersion(version=current_version,
+                                     all_versions=versions,
+                                     current_version=current_version)
+        to_version_idx = index[to_version]
+        if current_version is None:
+            current_version_idx = -1
+        else:
+            current_version_idx = index[current_version]
+        if to_version_idx < current_version_idx:
+            raise NothingToDo(current_version=current_version,
+                              to_version=to_version,
+                              action=NothingToDo.ACTION.upgrade)
+        # fresh installation starts from squashed baseline if there is a suitable one
+        baseline = None
+        if current_version is None:
+            baseline = self.__get_baseline(index, to_version_idx)
+        if baseline is not None:
+            current_version_idx = index[baseline]
+        return Plan(Plan.UPGRADE, current_version, to_version,
+                    versions[current_version_idx+1: to_version_idx+1], baseline)
 
-    def downgrade(self, to_version):
-        current_version = self.worker.get_current_version() # NOTE throws NoInstallation exception
-        available_versions = self.catalog.get_available_versions()
+    def plan_downgrade(self, current_version, to_version):
+        versions, index = self.get_versions()
         # check if we need downgrade at all
         if current_version == to_version:
             raise NothingToDo(current_version=current_version,
                               to_version=to_version,
                               action=NothingToDo.ACTION.downgrade)
-        if current_version is not None:
-            if available_versions.index(to_version) > available_versions.index(current_version):
-                raise NothingToDo(current_version=current_version,
-                                  to_version=to_version,
-                                  action=NothingToDo.ACTION.downgrade)
         # check whether installed version is available or not
-        if current_version not in available_versions:
+        if current_version not in index:
             raise UnavailableVersion(version=current_version,
-                                     all_versions=available_versions)
-        else:
-            current_version_idx = available_versions.index(current_version)
+                                     all_versions=versions,
+                                     current_version=current_version)
         # check whether requested version is available or not
-        if to_version not in available_versions:
+        if to_version not in index:
             raise UnavailableVersion(version=to_version,
-                                     all_versions=available_versions)
+                                     all_versions=versions,
+                                     current_version=current_version)
+        current_version_idx = index[current_version]
+        to_version_idx = index[to_version]
+        if to_version_idx > current_version_idx:
+            raise NothingToDo(current_version=current_version,
+                              to_version=to_version,
+                              action=NothingToDo.ACTION.downgrade)
+        needed_versions = versions[to_version_idx: current_version_idx+1]
+        needed_versions.reverse()
+        return Plan(Plan.DOWNGRADE, current_version, to_version, needed_versions)
 
-        # ok, downgrading
-        to_version_idx = available_versions.index(to_version)
-        needed_versions = available_versions[ to_version_idx: current_version_idx+1 ]
-        # build list of stages, where every list item is (version name, initialized stage object)
+    def plan_uninstall(self, current_version):
+        versions, index = self.get_versions()
+        if current_version not in index:
+            raise UnavailableVersion(version=current_version,
+                                     all_versions=versions,
+                                     current_version=current_version)
+        needed_versions = versions[:index[current_version]+1]
         needed_versions.reverse()
-        stages = [ (version, self.catalog.load_stage(version)) for version in needed_versions ]
-        self.worker.downgrade(stages)
+        return Plan(Plan.UNINSTALL, current_version, None, needed_versions)
+
+    def __get_baseline(self, index, to_version_idx):
+        """
+        Returns version of catalog baseline if it can be used to upgrade to to_version.
+        """
+        if not hasattr(self.catalog, 'get_baseline'):
+            return None
+        baseline = self.catalog.get_baseline()
+        if baseline not in index:
+            return None
+        if index[baseline] > to_version_idx:
+            return None
+        # baseline squashed in other order of versions would skip or repeat some of them
+        squashed = getattr(self.catalog.load_baseline(baseline), 'squashed_versions', None)
+        if squashed is not None and list(squashed) != self.versions[:index[baseline]+1]:
+            return None
+        return baseline
+
+
+class PlanOutdated(Exception):
+    def __init__(self, plan=None, current_version=None):
+        Exception.__init__(self, "Plan is for version \"%s\", but \"%s\" is installed" % (plan.current_version,
+                                                                                      current_version))
+        self.plan = plan
+        self.current_version = current_version
+
+
+class Manager(object):
+    def __init__(self, worker=None, catalog=None, prefetch=0, sort_key=None, lock=None):
+        """
+        You ask this class to upgrade/downgrade/etc your databases.
+        prefetch - how many stages to load ahead while executing current one, see iter_stages.
+        sort_key - how to order versions, see Planner.
+        lock - object with acquire() and release() methods, e.g. dbup.database.lock.MigrationLock.
+               If specified, it is held while plan is made and executed, so when several
+               processes upgrade the same database, one does the work and others find
+               nothing to do once they get the lock.
+        """
+        self.worker = worker
+        self.catalog = catalog
+        self.prefetch = prefetch
+        self.planner = Planner(catalog, sort_key=sort_key)
+        self.lock = lock
+        self.onPlanned = events.Event() # event triggered with plan right before it is executed
+
+    def upgrade(self, to_version):
+        self.__locked(lambda: self.__execute(self.plan_upgrade(to_version)))
+
+    def downgrade(self, to_version):
+        self.__locked(lambda: self.__execute(self.plan_downgrade(to_version)))
 
     def uninstall(self):
+        self.__locked(lambda: self.__execute(self.plan_uninstall()))
+
+    def __locked(self, func):
+        if self.lock is None:
+            return func()
+        self.lock.acquire()
+        try:
+            return func()
+        finally:
+            self.lock.release()
+
+    def plan_upgrade(self, to_version=None):
+        try:
+            current_version = self.worker.get_current_version()
+        except NoInstallation:
+            current_version = None
+        return self.planner.plan_upgrade(current_version, to_version)
+
+    def plan_downgrade(self, to_version):
         current_version = self.worker.get_current_version() # NOTE throws NoInstallation exception
-        available_versions = self.catalog.get_available_versions()
-        stages = []
-        if current_version in available_versions:
-            current_version_idx = available_versions.index(current_version)
-        else:
-            raise UnavailableVersion(version=current_version,
-                                     all_versions=available_versions)
-        needed_versions = available_versions[:current_version_idx+1]
-        needed_versions.reverse()
-        stages = [ (version, self.catalog.load_stage(version)) for version in needed_versions ]
-        self.worker.uninstall(stages)
+        return self.planner.plan_downgrade(current_version, to_version)
+
+    def plan_uninstall(self):
+        current_version = self.worker.get_current_version() # NOTE throws NoInstallation exception
+        return self.planner.plan_uninstall(current_version)
+
+    def verify(self):
+        """
+        Compares checksums of applied stages recorded by worker with the catalog.
+        Returns list of (version, recorded checksum, catalog checksum) for every
+        applied stage that has been changed since, catalog checksum is None
+        if version is not in catalog anymore.
+        Catalog only re-reads files that changed since the last check,
+        see DirectoryVersionCatalog.get_checksum.
+        """
+        if not hasattr(self.catalog, 'get_checksum'):
+            raise Exception("Catalog %s does not support checksums" % self.catalog.__class__.__name__)
+        _versions, index = self.planner.get_versions()
+        drifted = []
+        for version, _applied_at, _duration, checksum in self.worker.get_history():
+            if checksum is None:
+                continue
+            if version not in index:
+                drifted.append((version, checksum, None))
+                continue
+            actual = self.catalog.get_checksum(version)
+            if actual != checksum:
+                drifted.append((version, checksum, actual))
+        self.__save_catalog()
+        return drifted
+
+    def execute(self, plan):
+        """
+        Executes plan made earlier, raises PlanOutdated if database is not
+        at the version plan was made for anymore.
+        """
+        def check_and_execute():
+            try:
+                current_version = self.worker.get_current_version()
+            except NoInstallation:
+                current_version = None
+            if current_version != plan.current_version:
+                raise PlanOutdated(plan=plan, current_version=current_version)
+            self.__execute(plan)
+        self.__locked(check_and_execute)
+
+    def __execute(self, plan):
+        self.onPlanned(plan)
+        # stages are (version name, initialized stage object), loaded as worker gets to them
+        stages = iter_stages(self.catalog, plan.versions, self.prefetch)
+        try:
+            if plan.action == Plan.UPGRADE:
+                if plan.baseline is not None:
+                    stages = itertools.chain([ (plan.baseline, self.catalog.load_baseline(plan.baseline)) ], stages)
+                self.worker.upgrade(stages)
+            elif plan.action == Plan.DOWNGRADE:
+                self.worker.downgrade(stages)
+            elif plan.action == Plan.UNINSTALL:
+                self.worker.uninstall(stages)
+            else:
+                raise ValueError("Unknown action %s" % plan.action)
+        finally:
+            self.__save_catalog()
 
+    def __save_catalog(self):
+        # checksums calculated during the run are written to catalog cache once, at the end
+        if hasattr(self.catalog, 'save_manifest'):
+            self.catalog.save_manifest()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import threading
+import Queue
+
+from dbup.compat import json
+from dbup.version_catalog import write_file_atomically
+
+
+class JsonLinesSink(object):
+    """
+    Appends every metrics record to a file as one JSON object per line.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'a')
+
+    def task(self, version, metrics):
+        self.__write(dict(metrics, event='task', version=version))
+
+    def task_group(self, metrics):
+        self.__write(dict(metrics, event='task_group'))
+
+    def __write(self, record):
+        record['timestamp'] = time.time()
+        self.f.write(json.dumps(record, sort_keys=True) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class PrometheusTextfileSink(object):
+    """
+    Writes metrics of the last run in prometheus text format,
+    to be picked up by node_exporter's textfile collector.
+    File is rewritten as a whole after every task group.
+    """
+    TASK_METRICS = (('wall_time', 'dbup_stage_wall_seconds', "Wall time spent on stage."),
+                    ('cpu_time', 'dbup_stage_cpu_seconds', "CPU time spent by dbup on stage."),
+                    ('statements', 'dbup_stage_statements', "Statements executed by stage."),
+                    ('rows', 'dbup_stage_rows', "Rows affected by stage."))
+    GROUP_METRICS = (('wall_time', 'dbup_run_wall_seconds', "Wall time of the last run."),
+                     ('cpu_time', 'dbup_run_cpu_seconds', "CPU time of the last run."),
+                     ('statements', 'dbup_run_statements', "Statements executed by the last run."),
+                     ('rows', 'dbup_run_rows', "Rows affected by the last run."),
+                     ('tasks', 'dbup_run_stages', "Stages executed by the last run."))
+
+    def __init__(self, path, labels=None):
+        """
+        labels - dictionary of labels added to every metric, e.g. {'database': 'shard1'}
+        """
+        self.path = path
+        self.labels = labels or {}
+        self.tasks = []
+
+    def task(self, version, metrics):
+        self.tasks.append((version, metrics))
+
+    def task_group(self, metrics):
+        lines = []
+        for key, name, help in self.TASK_METRICS:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            for version, task_metrics in self.tasks:
+                lines.append("%s%s %s" % (name, self.__labels(version=version), task_metrics[key]))
+        for key, name, help in self.GROUP_METRICS:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s%s %s" % (name, self.__labels(action=metrics['action']), metrics[key]))
+        lines.append("# HELP dbup_run_timestamp_seconds When the last run has finished.")
+        lines.append("# TYPE dbup_run_timestamp_seconds gauge")
+        lines.append("dbup_run_timestamp_seconds%s %f" % (self.__labels(action=metrics['action']), time.time()))
+        write_file_atomically(self.path, "\n".join(lines) + "\n")
+        self.tasks = []
+
+    def __labels(self, **extra):
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ""
+        pairs = [ '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                  for key, value in sorted(labels.items()) ]
+        return "{%s}" % ",".join(pairs)
+
+    def close(self):
+        pass
+
+
+class MetricsDispatcher(object):
+    """
+    Passes metrics from worker events to sinks in a background thread,
+    so slow sinks do not make migration (and locks it holds) any longer.
+    Usage:
+        dispatcher = MetricsDispatcher([JsonLinesSink('metrics.jsonl')])
+        dispatcher.attach(worker)
+        ...
+        dispatcher.close()
+    """
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.__dispatch)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def attach(self, worker):
+        worker.onTaskMetrics += self.task
+        worker.onTaskGroupMetrics += self.task_group
+
+    def task(self, version, metrics):
+        self.queue.put(('task', (version, metrics)))
+
+    def task_group(self, metrics):
+        self.queue.put(('task_group', (metrics,)))
+
+    def close(self):
+        """
+        Waits until all queued metrics are written and closes sinks.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for sink in self.sinks:
+            sink.close()
+
+    def __dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            method, args = item
+            for sink in self.sinks:
+                try:
+                    getattr(sink, method)(*args)
+                except Exception:
+                    # metrics must never break migration
+                    import traceback
+                    traceback.print_exc()
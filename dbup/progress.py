@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import sys
+import time
+import threading
+
+from dbup.compat import json
+from dbup.version_catalog import write_file_atomically
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class StageTimings(object):
+    """
+    Durations of stages measured by past runs, kept in a JSON file, so that
+    progress of the next run can be told in time rather than in stages.
+    Durations of upgrading and downgrading a version are kept apart.
+    Every new measurement is averaged with the one known before.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.timings = {'up': {}, 'down': {}}
+        try:
+            f = open(path, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                timings = json.load(f)
+            except ValueError:
+                # broken file, it's going to be rewritten
+                return
+        finally:
+            f.close()
+        for direction in self.timings:
+            self.timings[direction].update(timings.get(direction, {}))
+
+    def get(self, direction, version):
+        """
+        Returns how long stage took before in seconds, or None if it was never measured.
+        """
+        return self.timings[direction].get(version)
+
+    def record(self, direction, version, seconds):
+        self.lock.acquire()
+        try:
+            known = self.timings[direction].get(version)
+            if known is not None:
+                seconds = (known + seconds) / 2.0
+            self.timings[direction][version] = seconds
+            # it's an aid only, never fail migration because of it
+            try:
+                write_file_atomically(self.path, json.dumps(self.timings, sort_keys=True))
+            except (IOError, OSError):
+                pass
+        finally:
+            self.lock.release()
+
+
+class ProgressReporter(object):
+    """
+    Prints how far the run is, based on worker events:
+        [0042] 3/10 stages, 27% done, elapsed 0:01:20, ETA 0:03:35
+        [0042] 120000/500000 rows, 1500 rows/s, 41% done, elapsed 0:02:40, ETA 0:03:51
+        [0042] OK in 0:01:40
+    Stages are weighted by how long they took before according to timings,
+    stages that were never measured are expected to take as long as an average one.
+    Without timings every stage weighs the same. ETA is corrected by how
+    much faster or slower than expected completed stages were.
+    Row progress is printed at most once per 'interval' seconds per stage.
+    Usage:
+        plan = manager.plan_upgrade()
+        reporter = ProgressReporter(plan, StageTimings('timings.json'))
+        reporter.attach(worker)
+        manager.execute(plan)
+    """
+    def __init__(self, plan, timings=None, stream=None, interval=5.0):
+        self.versions = plan.get_executed_versions()
+        self.direction = plan.action == plan.UPGRADE and 'up' or 'down'
+        self.timings = timings
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.expected = self.__get_expected()
+        self.total = sum(self.expected.values()) or 1.0
+        self.started = None
+        # version => time it was started at
+        self.running = {}
+        # version => fraction of stage done, as reported by stage
+        self.fractions = {}
+        self.printed = {}
+        self.completed = set()
+        self.completed_expected = 0.0
+        self.completed_actual = 0.0
+
+    def __get_expected(self):
+        known = {}
+        if self.timings is not None:
+            for version in self.versions:
+                seconds = self.timings.get(self.direction, version)
+                if seconds is not None:
+                    known[version] = seconds
+        self.measured = bool(known)
+        if known:
+            default = sum(known.values()) / len(known)
+        else:
+            default = 1.0
+        return dict([ (version, known.get(version, default)) for version in self.versions ])
+
+    def attach(self, worker):
+        worker.onNewTask += self.task_started
+        worker.onTaskProgress += self.task_progress
+        worker.onTaskMetrics += self.task_measured
+        worker.onTaskCompleted += self.task_completed
+
+    def task_started(self, version):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if self.started is None:
+                self.started = now
+            self.running[version] = now
+            position = len(self.completed) + len(self.running)
+            self.__write("[%s] %d/%d stages, %s" % (version, position, len(self.versions),
+                                                     self.__get_status(now)))
+        finally:
+            self.lock.release()
+
+    def task_progress(self, version, done, total, unit):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if version not in self.running:
+                return
+            if total:
+                self.fractions[version] = min(1.0, float(done) / total)
+            if now - self.printed.get(version, self.running[version]) < self.interval:
+                return
+            self.printed[version] = now
+            elapsed = now - self.running[version]
+            if total:
+                amount = "%d/%d %s" % (done, total, unit)
+            else:
+                amount = "%d %s" % (done, unit)
+            if elapsed > 0:
+                amount += ", %d %s/s" % (done / elapsed, unit)
+            self.__write("[%s] %s, %s" % (version, amount, self.__get_status(now)))
+        finally:
+            self.lock.release()
+
+    def task_measured(self, version, metrics):
+        if self.timings is not None:
+            self.timings.record(self.direction, version, metrics['wall_time'])
+
+    def task_completed(self, version):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            started = self.running.pop(version, now)
+            self.fractions.pop(version, None)
+            self.completed.add(version)
+            self.completed_expected += self.expected.get(version, 0.0)
+            self.completed_actual += now - started
+            self.__write("[%s] OK in %s" % (version, format_duration(now - started)))
+        finally:
+            self.lock.release()
+
+    def __get_status(self, now):
+        done = self.completed_expected
+        for version, started in self.running.items():
+            expected = self.expected.get(version, 0.0)
+            if version in self.fractions:
+                done += expected * self.fractions[version]
+            else:
+                # running stage is never taken for complete until it says so
+                done += min(now - started, expected * 0.99)
+        # how much faster (<1) or slower (>1) than expected this run is
+        speed = 1.0
+        if self.completed_expected > 0 and self.completed_actual > 0:
+            speed = self.completed_actual / self.completed_expected
+        remaining = max(0.0, self.total - done) * speed
+        if self.measured or self.completed:
+            eta = format_duration(remaining)
+        else:
+            # every stage weighs a second, nothing to tell ETA from yet
+            eta = "unknown"
+        return "%d%% done, elapsed %s, ETA %s" % (100 * done / self.total,
+                                                   format_duration(now - self.started), eta)
+
+    def __write(self, line):
+        self.stream.write(line + "\n")
+        self.stream.flush()
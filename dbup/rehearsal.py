@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import re
+import os
+import heapq
+import shutil
+import sqlite3
+import tempfile
+import threading
+import traceback
+
+from dbup.manager import Manager
+from dbup.worker import SqlWorker
+from dbup.worker.parallel import ParallelSqlWorker, get_dependencies
+from dbup.database.profiler import StatementProfiler
+
+
+re_sqlite_path = re.compile(r'^sqlite:///(?P<path>.+)$')
+
+
+def clone_sqlite_database(path, tmp_dir=None):
+    """
+    Copies sqlite database at path into a temporary file and returns its path.
+    Uses sqlite backup API where python provides it, so database may be in use.
+    """
+    fd, clone_path = tempfile.mkstemp(prefix='dbup-rehearsal-', suffix='.sqlite', dir=tmp_dir)
+    os.close(fd)
+    source = sqlite3.connect(path)
+    try:
+        if hasattr(source, 'backup'):
+            target = sqlite3.connect(clone_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        else:
+            shutil.copyfile(path, clone_path)
+    finally:
+        source.close()
+    return clone_path
+
+def get_scratch(connection_string, tmp_dir=None):
+    """
+    Returns connection string of a disposable copy of sqlite database,
+    so rehearsal leaves the file itself untouched. Connection strings
+    of other databases are returned as they are, they must point
+    to a scratch copy already.
+    """
+    match = re_sqlite_path.match(connection_string)
+    if match is None or match.group('path') == ':memory:':
+        return connection_string
+    return "sqlite:///%s" % clone_sqlite_database(match.group('path'), tmp_dir)
+
+def get_scale_factor(text, scale):
+    """
+    Returns the largest ratio of tables from 'scale' mentioned in statement text, 1.0 if none is.
+    """
+    factor = None
+    for table, ratio in scale.items():
+        if re.search(r'\b%s\b' % re.escape(table), text, re.IGNORECASE):
+            factor = max(factor, ratio)
+    if factor is None:
+        return 1.0
+    return factor
+
+def estimate_window(versions, dependencies, durations, concurrency=1):
+    """
+    Returns how long stages of given durations take when run the way
+    ParallelSqlWorker runs them: stages are started in order as soon as
+    their dependencies have completed, up to 'concurrency' at a time.
+    """
+    pending = list(versions)
+    running = []
+    done = set()
+    now = 0.0
+    while pending or running:
+        for version in list(pending):
+            if len(running) >= concurrency:
+                break
+            if dependencies.get(version, set()) <= done:
+                pending.remove(version)
+                heapq.heappush(running, (now + durations.get(version, 0.0), version))
+        if not running:
+            break
+        now, version = heapq.heappop(running)
+        done.add(version)
+    return now
+
+
+class StageTiming(object):
+    """
+    How a stage did on rehearsal.
+    seconds - wall time the stage took on scratch database
+    scaled_seconds - expected time on the real database, see Rehearsal
+    """
+    def __init__(self, version):
+        self.version = version
+        self.status = 'skipped'
+        self.seconds = 0.0
+        self.scaled_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+
+
+class RehearsalResult(object):
+    """
+    Timings of every planned stage, in plan order, and the estimated maintenance window.
+    error is formatted traceback of the failure, None if all stages succeeded.
+    """
+    def __init__(self, plan, timings, estimate, concurrency, error=None):
+        self.plan = plan
+        self.timings = timings
+        self.estimate = estimate
+        self.concurrency = concurrency
+        self.error = error
+
+    def get_failed(self):
+        return [ timing for timing in self.timings if timing.status == 'failed' ]
+
+    def __str__(self):
+        lines = [str(self.plan).splitlines()[0], ""]
+        lines.append("%-20s %-8s %10s %10s %10s %10s" % ('version', 'status', 'seconds',
+                                                        'expected', 'statements', 'rows'))
+        for timing in self.timings:
+            lines.append("%-20s %-8s %10.2f %10.2f %10d %10d" % (timing.version, timing.status,
+                                                                timing.seconds, timing.scaled_seconds,
+                                                                timing.statements, timing.rows))
+        lines.append("")
+        total = sum([ timing.scaled_seconds for timing in self.timings ])
+        lines.append("Expected time of stages one after another: %.2fs." % total)
+        lines.append("Expected maintenance window with %d at a time: %.2fs." % (self.concurrency,
+                                                                               self.estimate))
+        if self.error is not None:
+            lines.append("")
+            lines.append("Rehearsal failed:")
+            lines.append(self.error.rstrip())
+        return "\n".join(lines)
+
+
+class Rehearsal(object):
+    """
+    Runs an upgrade on a disposable copy of database to find out how long
+    it takes and whether it fails, without touching the real database.
+    Usage:
+        backend = Backend(get_scratch('sqlite:///prod-copy.db'))
+        result = Rehearsal(catalog, scale={'users': 120.0}).run(backend)
+        print result
+
+    Statements of every stage are timed, and time of a statement that mentions
+    tables from 'scale' is multiplied by the largest of their ratios, e.g.
+    rows in real table divided by rows in the copy. The rest of stage time
+    is taken as is. Maintenance window is estimated from scaled timings
+    and stage dependencies, see estimate_window.
+    With concurrency above 1 independent stages are rehearsed at the same
+    time by ParallelSqlWorker, scratch database must allow that. Sqlite has
+    a single writer, so stages are rehearsed one after another there and
+    the window for 'concurrency' stages at a time is worked out from their timings.
+    """
+    def __init__(self, catalog, scale=None, concurrency=1, sort_key=None, prefetch=0):
+        self.catalog = catalog
+        self.scale = scale or {}
+        self.concurrency = max(1, concurrency)
+        self.sort_key = sort_key
+        self.prefetch = prefetch
+
+    def run(self, backend, to_version=None):
+        """
+        Upgrades database of backend to to_version, latest by default.
+        Raises NothingToDo and UnavailableVersion like Manager.upgrade,
+        failures of stages are reported in the result instead.
+        """
+        profiler = StatementProfiler()
+        if self.concurrency > 1 and backend.get_engine().name != 'sqlite':
+            worker = ParallelSqlWorker(backend=backend, concurrency=self.concurrency, profiler=profiler)
+        else:
+            worker = SqlWorker(backend=backend, profiler=profiler)
+        manager = Manager(worker=worker, catalog=self.catalog, prefetch=self.prefetch,
+                          sort_key=self.sort_key)
+        plan = manager.plan_upgrade(to_version)
+        versions = plan.get_executed_versions()
+        timings = dict([ (version, StageTiming(version)) for version in versions ])
+        lock = threading.Lock()
+        def started(version):
+            lock.acquire()
+            try:
+                timings[version].status = 'failed' # until it completes
+            finally:
+                lock.release()
+        def measured(version, metrics):
+            lock.acquire()
+            try:
+                timing = timings[version]
+                timing.status = 'ok'
+                timing.seconds = metrics['wall_time']
+                timing.statements = metrics['statements']
+                timing.rows = metrics['rows']
+            finally:
+                lock.release()
+        worker.onNewTask += started
+        worker.onTaskMetrics += measured
+        error = None
+        try:
+            manager.execute(plan)
+        except Exception:
+            error = traceback.format_exc()
+        self.__scale(timings, profiler)
+        durations = dict([ (version, timing.scaled_seconds) for version, timing in timings.items() ])
+        estimate = estimate_window(versions, self.__get_dependencies(plan), durations, self.concurrency)
+        return RehearsalResult(plan, [ timings[version] for version in versions ],
+                               estimate, self.concurrency, error)
+
+    def __scale(self, timings, profiler):
+        statement_time = {}
+        scaled_time = {}
+        for stats in profiler.get_slowest(top=None):
+            if stats.stage not in timings:
+                continue
+            statement_time[stats.stage] = statement_time.get(stats.stage, 0.0) + stats.total_time
+            scaled = stats.total_time * get_scale_factor(stats.text, self.scale)
+            scaled_time[stats.stage] = scaled_time.get(stats.stage, 0.0) + scaled
+        for version, timing in timings.items():
+            if timing.status == 'failed':
+                # failed stages report no metrics, statements they got through is all there is
+                timing.seconds = statement_time.get(version, 0.0)
+            overhead = max(0.0, timing.seconds - statement_time.get(version, 0.0))
+            timing.scaled_seconds = overhead + scaled_time.get(version, 0.0)
+
+    def __get_dependencies(self, plan):
+        if self.concurrency == 1:
+            return {}
+        stages = []
+        if plan.baseline is not None:
+            stages.append((plan.baseline, self.catalog.load_baseline(plan.baseline)))
+        stages.extend([ (version, self.catalog.load_stage(version)) for version in plan.versions ])
+        return get_dependencies(stages)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import errno
+import shutil
+import hashlib
+import sqlite3
+
+import sqlalchemy
+
+from dbup.manager import Manager
+from dbup.worker import SqlWorker
+
+
+class TemplateCache(object):
+    """
+    Keeps sqlite databases migrated to some version of catalog, so test suites
+    can get migrated database by copying a file instead of running all stages.
+    Templates are keyed by hash of catalog contents up to the requested version,
+    editing any stage file makes the next call build a new template.
+    Catalog must provide get_checksum, e.g. DirectoryVersionCatalog does.
+    Usage:
+        cache = TemplateCache(DirectoryVersionCatalog('versions'), '/tmp/dbup-templates')
+        cache.create_database('/tmp/test.db')
+    """
+    def __init__(self, catalog, cache_dir, sort_key=None):
+        """
+        sort_key - key versions are ordered by, see Manager.
+        """
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.sort_key = sort_key
+
+    def get_key(self, to_version=None):
+        """
+        Returns hash of all versions up to and including to_version (latest by default).
+        """
+        available_versions = self.catalog.get_available_versions()
+        if self.sort_key is not None:
+            available_versions.sort(key=self.sort_key)
+        if to_version is None:
+            to_version = available_versions[-1]
+        digest = hashlib.sha1()
+        for version in available_versions[:available_versions.index(to_version)+1]:
+            digest.update("%s\0%s\0" % (version, self.catalog.get_checksum(version)))
+        return digest.hexdigest()
+
+    def get_template(self, to_version=None):
+        """
+        Returns path to template database migrated to to_version, building it if needed.
+        """
+        path = os.path.join(self.cache_dir, "%s.sqlite" % self.get_key(to_version))
+        if not os.path.isfile(path):
+            self.__build(path, to_version)
+        return path
+
+    def create_database(self, path, to_version=None, link=False):
+        """
+        Puts database migrated to to_version at path specified.
+        link - hardlink template instead of copying it. Fast, but every change
+               to the database changes the template too, so only use it read-only.
+        """
+        template = self.get_template(to_version)
+        if os.path.exists(path):
+            os.remove(path)
+        if link:
+            os.link(template, path)
+        else:
+            shutil.copyfile(template, path)
+        return path
+
+    def restore_into(self, connection, to_version=None):
+        """
+        Copies template into sqlite3 connection specified, e.g. to in-memory database.
+        Uses sqlite backup API where python provides it, replays SQL dump otherwise.
+        """
+        source = sqlite3.connect(self.get_template(to_version))
+        try:
+            if hasattr(source, 'backup'):
+                source.backup(connection)
+            else:
+                connection.executescript(";\n".join(source.iterdump()))
+                connection.commit()
+        finally:
+            source.close()
+
+    def __build(self, path, to_version):
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # private engine, so no pooled connection keeps file open after build
+        engine = sqlalchemy.create_engine("sqlite:///%s" % tmp_path)
+        try:
+            manager = Manager(worker=SqlWorker(engine=engine), catalog=self.catalog,
+                              sort_key=self.sort_key)
+            manager.upgrade(to_version)
+        finally:
+            engine.dispose()
+        os.rename(tmp_path, path)
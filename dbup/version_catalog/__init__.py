@@ -26,10 +26,56 @@
 
 import os
 import sys
+import time
+import errno
+import hashlib
+import threading
+import cPickle as pickle
 
 
 j = os.path.join
 
+# Directory inside catalog where squashed baseline lives, see dbup.version_catalog.squash
+BASELINE_DIR = '_baseline'
+
+# Directories modified less than that many seconds ago are not trusted
+# to have a final mtime, filesystems with coarse timestamps could hide changes.
+MTIME_GRANULARITY = 2
+
+# Keys every manifest has, see DirectoryVersionCatalog.get_manifest
+MANIFEST_KEYS = frozenset(['mtime', 'versions', 'paths', 'checksums'])
+
+
+def write_file_atomically(path, data):
+    """
+    Writes data into a temporary file next to 'path' and renames it into place,
+    so concurrent readers never see half-written file.
+    """
+    tmp_path = get_tmp_path(path)
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    replace_file(tmp_path, path)
+
+def get_tmp_path(path):
+    """
+    Returns path of a temporary file to write next to 'path' before replace_file.
+    """
+    return "%s.%d.tmp" % (path, os.getpid())
+
+def replace_file(tmp_path, path):
+    """
+    Renames completely written file at tmp_path to 'path', replacing existing file.
+    """
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # windows does not replace existing files on rename
+        os.remove(path)
+        os.rename(tmp_path, path)
+
 
 class DirectoryVersionCatalog(object):
     """
@@ -42,23 +88,264 @@ class DirectoryVersionCatalog(object):
           + 02/__init__.py
           + 03/__init__.py
           ...
+    Directories starting with '_' or '.' are not versions.
+    _baseline/<version>/ may contain a stage that replaces all stages up to
+    and including <version> on fresh installations.
+
+    Result of directory scan is kept in a manifest, which is valid until mtime
+    of the catalog directory changes. If cache_dir is specified, manifest is also
+    stored there, so next runs do not have to scan catalog at all.
+    Manifest also keeps checksums of version directories, see get_checksum.
+
+    Compiled stage code is kept by code_cache, by default the one all catalogs
+    with the same cache_dir share, see dbup.version_catalog.codecache.
     """
-    def __init__(self, path='.'):
+    def __init__(self, path='.', cache_dir=None, code_cache=None):
         self.path = path
+        self.cache_dir = cache_dir
+        self.manifest = None
+        # whether manifest has changed since it was read or written
+        self.dirty = False
+        self.lock = threading.RLock()
+        if code_cache is None:
+            from dbup.version_catalog.codecache import get_code_cache
+            code_cache = get_code_cache(cache_dir)
+        self.code_cache = code_cache
 
     def get_available_versions(self):
-        versions = [ d for d in os.listdir(self.path) if os.path.isdir(j(self.path, d)) ]
+        return list(self.get_manifest()['versions'])
+
+    def get_manifest(self):
+        """
+        Returns dictionary with the following keys:
+          versions - sorted list of versions
+          paths - dictionary of version => absolute path of the version directory
+          checksums - dictionary of version => (signature, checksum), filled in lazily
+          mtime - mtime of catalog directory at the moment of scan
+        """
+        self.lock.acquire()
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if self.manifest is None:
+                self.manifest = self.__read_manifest()
+            if self.manifest is None or self.manifest['mtime'] != mtime:
+                self.manifest = self.__scan(mtime, self.manifest)
+                self.__write_manifest()
+                self.dirty = False
+            return self.manifest
+        finally:
+            self.lock.release()
+
+    def get_checksum(self, version):
+        """
+        Returns sha1 hex digest of all files in version directory.
+        Files are only read again if their sizes or mtimes have changed
+        since the checksum was calculated last time.
+        """
+        self.lock.acquire()
+        try:
+            manifest = self.get_manifest()
+            if version not in manifest['paths']:
+                raise Exception("Version %s is not in catalog %s" % (version, self.path))
+            version_path = manifest['paths'][version]
+            files = self.__list_files(version_path)
+            signature = [ (name, st.st_size, st.st_mtime) for name, st in files ]
+            cached = manifest['checksums'].get(version)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            digest = hashlib.sha1()
+            for name, _st in files:
+                digest.update(name)
+                digest.update('\0')
+                f = open(j(version_path, name), 'rb')
+                try:
+                    while True:
+                        chunk = f.read(65536)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                finally:
+                    f.close()
+                digest.update('\0')
+            checksum = digest.hexdigest()
+            manifest['checksums'][version] = (signature, checksum)
+            self.dirty = True
+            return checksum
+        finally:
+            self.lock.release()
+
+    def save_manifest(self):
+        """
+        Writes manifest into cache_dir if it has changed. Checksums are calculated
+        one by one, this saves all of them at once, Manager calls it after every run.
+        """
+        self.lock.acquire()
+        try:
+            if self.dirty:
+                self.__write_manifest()
+                self.dirty = False
+        finally:
+            self.lock.release()
+
+    def __list_files(self, version_path):
+        """
+        Returns sorted list of (relative path, stat result) for every file in version directory.
+        Compiled python files are skipped.
+        """
+        files = []
+        for root, dirs, names in os.walk(version_path):
+            dirs.sort()
+            for name in names:
+                if name.endswith('.pyc') or name.endswith('.pyo'):
+                    continue
+                path = j(root, name)
+                files.append((os.path.relpath(path, version_path), os.stat(path)))
+        files.sort()
+        return files
+
+    def __scan(self, mtime, old_manifest=None):
+        versions = [ d for d in os.listdir(self.path)
+                     if d[0] not in '_.' and os.path.isdir(j(self.path, d)) ]
         versions.sort()
-        return versions
+        if time.time() - mtime < MTIME_GRANULARITY:
+            # too fresh to trust, scan again next time
+            mtime = None
+        checksums = {}
+        if old_manifest is not None:
+            checksums = dict([ (v, c) for v, c in old_manifest['checksums'].items() if v in versions ])
+        return {'mtime': mtime,
+                'versions': versions,
+                'paths': dict([ (v, os.path.abspath(j(self.path, v))) for v in versions ]),
+                'checksums': checksums}
+
+    def __manifest_path(self):
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1(os.path.abspath(self.path)).hexdigest()
+        return j(self.cache_dir, "%s.manifest" % key)
+
+    def __read_manifest(self):
+        path = self.__manifest_path()
+        if path is None:
+            return None
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                manifest = pickle.load(f)
+            except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError,
+                    pickle.UnpicklingError):
+                # broken manifest, just scan again
+                return None
+        finally:
+            f.close()
+        if not isinstance(manifest, dict) or not MANIFEST_KEYS.issubset(manifest):
+            # written by another version of dbup
+            return None
+        return manifest
+
+    def __write_manifest(self):
+        path = self.__manifest_path()
+        if path is None:
+            return
+        # without manifest catalog is scanned again next time, nothing worse
+        try:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            write_file_atomically(path, pickle.dumps(self.manifest, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            pass
 
     def load_stage(self, version):
-        # At this point, <version>/__init__.py must be import-able
+        stage = self.__load_stage_from(j(self.path, version))
+        # files are only hashed if checksum is needed, e.g. to record history
+        stage.get_checksum = lambda: self.get_checksum(version)
+        return stage
+
+    def get_baseline(self):
+        """
+        Returns version squashed baseline brings database to, or None if there is no baseline.
+        """
+        baseline_path = j(self.path, BASELINE_DIR)
+        if not os.path.isdir(baseline_path):
+            return None
+        versions = [ d for d in os.listdir(baseline_path) if os.path.isdir(j(baseline_path, d)) ]
+        if not versions:
+            return None
+        versions.sort()
+        return versions[-1]
+
+    def load_baseline(self, version):
+        return self.__load_stage_from(j(self.path, BASELINE_DIR, version))
+
+    def __load_stage_from(self, path):
+        # At this point, <path>/__init__.py must be import-able
         stage_module = {}
-        version_path = j(self.path, version, '__init__.py')
+        version_path = j(path, '__init__.py')
         if not os.path.isfile(version_path):
             raise Exception("Could not find version file %s" % (version_path))
-        execfile(version_path, stage_module)
+        exec self.code_cache.get_code(version_path) in stage_module
         Stage = stage_module['Stage']
         stage = Stage()
-        stage.current_path = os.path.abspath(j(self.path, version))
+        stage.current_path = os.path.abspath(path)
         return stage
+
+
+class CachedVersionCatalog(object):
+    """
+    Wraps another catalog and remembers its available versions and loaded stages,
+    so several workers (e.g. a fleet of shards) can share one catalog scan
+    and load every stage only once.
+    Stage instances are shared between callers, so stages must not keep
+    per-database state in their attributes.
+    """
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.versions = None
+        self.stages = {}
+        self.checksums = {}
+
+    def get_available_versions(self):
+        self.lock.acquire()
+        try:
+            if self.versions is None:
+                self.versions = self.catalog.get_available_versions()
+            return list(self.versions)
+        finally:
+            self.lock.release()
+
+    def get_baseline(self):
+        if not hasattr(self.catalog, 'get_baseline'):
+            return None
+        return self.catalog.get_baseline()
+
+    def load_baseline(self, version):
+        return self.catalog.load_baseline(version)
+
+    def get_checksum(self, version):
+        self.lock.acquire()
+        try:
+            if version not in self.checksums:
+                self.checksums[version] = self.catalog.get_checksum(version)
+            return self.checksums[version]
+        finally:
+            self.lock.release()
+
+    def save_manifest(self):
+        if hasattr(self.catalog, 'save_manifest'):
+            self.catalog.save_manifest()
+
+    def load_stage(self, version):
+        self.lock.acquire()
+        try:
+            if version not in self.stages:
+                self.stages[version] = self.catalog.load_stage(version)
+            return self.stages[version]
+        finally:
+            self.lock.release()
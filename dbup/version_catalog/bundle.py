@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import imp
+import mmap
+import errno
+import struct
+import shutil
+import marshal
+import hashlib
+import tempfile
+
+from dbup.version_catalog import DirectoryVersionCatalog, BASELINE_DIR, write_file_atomically, \
+                                 get_tmp_path, replace_file
+
+
+j = os.path.join
+
+MAGIC = 'DBUPBNDL'
+FORMAT_VERSION = 1
+# magic, format version, header length
+PREAMBLE = struct.Struct('>8sII')
+STAGE_FILE = '__init__.py'
+
+
+def list_files(path):
+    """
+    Returns sorted list of relative paths of all files in directory, compiled python files are skipped.
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in names:
+            if name.endswith('.pyc') or name.endswith('.pyo'):
+                continue
+            files.append(os.path.relpath(j(root, name), path))
+    files.sort()
+    return files
+
+def build_bundle(catalog_path, output):
+    """
+    Packs catalog directory into single file at output path.
+    Bundle starts with an index of versions and offsets of their files,
+    stage code is stored compiled, so loading it later needs no parsing.
+    Files are copied piece by piece, so catalog never has to fit in memory:
+    data goes to a temporary file first, as index must precede it and is
+    only known at the end, then both are written next to output and renamed
+    into place.
+    """
+    catalog = DirectoryVersionCatalog(catalog_path)
+    versions = catalog.get_available_versions()
+    entries = {}
+    blob = tempfile.TemporaryFile()
+    try:
+        def add_data(data):
+            offset = blob.tell()
+            blob.write(data)
+            return (offset, len(data))
+        def add_file(path):
+            offset = blob.tell()
+            f = open(path, 'rb')
+            try:
+                shutil.copyfileobj(f, blob)
+            finally:
+                f.close()
+            return (offset, blob.tell() - offset)
+        def add_directory(key, path, checksum):
+            files = {}
+            code = None
+            for name in list_files(path):
+                if name == STAGE_FILE:
+                    # stage files are small and get compiled anyway
+                    f = open(j(path, name), 'rb')
+                    try:
+                        data = f.read()
+                    finally:
+                        f.close()
+                    files[name] = add_data(data)
+                    compiled = compile(data, "%s/%s/%s" % (os.path.basename(output), key, name), 'exec')
+                    code = add_data(marshal.dumps(compiled))
+                else:
+                    files[name] = add_file(j(path, name))
+            entries[key] = {'files': files, 'code': code, 'checksum': checksum}
+        for version in versions:
+            add_directory(version, j(catalog_path, version), catalog.get_checksum(version))
+        baseline = catalog.get_baseline()
+        if baseline is not None:
+            add_directory("%s/%s" % (BASELINE_DIR, baseline), j(catalog_path, BASELINE_DIR, baseline), None)
+        header = marshal.dumps({'python_magic': imp.get_magic(),
+                                'versions': versions,
+                                'baseline': baseline,
+                                'entries': entries})
+        tmp_path = get_tmp_path(output)
+        f = open(tmp_path, 'wb')
+        try:
+            try:
+                f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+                f.write(header)
+                blob.seek(0)
+                shutil.copyfileobj(blob, f)
+            finally:
+                f.close()
+        except:
+            os.remove(tmp_path)
+            raise
+    finally:
+        blob.close()
+    replace_file(tmp_path, output)
+    return output
+
+
+class BundleVersionCatalog(object):
+    """
+    Version catalog that loads patches from a single file made by build_bundle,
+    e.g. with 'dbup bundle OUTPUT -p versions/'.
+    File is memory-mapped and stages are loaded from it only when asked for,
+    so startup costs the same no matter how many versions there are.
+    Files shipped along with a stage are extracted to extract_dir when stage
+    is loaded, current_path of stage points there. Use read_file to get them
+    without extraction.
+    """
+    def __init__(self, path, extract_dir=None):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, format_version, header_length = PREAMBLE.unpack(self.data[:PREAMBLE.size])
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise Exception("%s is not a dbup bundle of supported format" % path)
+        header_end = PREAMBLE.size + header_length
+        header = marshal.loads(self.data[PREAMBLE.size:header_end])
+        self.data_offset = header_end
+        self.versions = header['versions']
+        self.baseline = header['baseline']
+        self.entries = header['entries']
+        # code compiled by another python version cannot be used
+        self.use_compiled = header['python_magic'] == imp.get_magic()
+        if extract_dir is None:
+            extract_dir = j(tempfile.gettempdir(), 'dbup-bundles')
+        self.extract_dir = j(extract_dir, hashlib.sha1(self.data[:header_end]).hexdigest())
+
+    def get_available_versions(self):
+        return list(self.versions)
+
+    def get_checksum(self, version):
+        return self.entries[version]['checksum']
+
+    def get_baseline(self):
+        return self.baseline
+
+    def load_stage(self, version):
+        stage = self.__load_stage_from(version)
+        stage.checksum = self.get_checksum(version)
+        return stage
+
+    def load_baseline(self, version):
+        return self.__load_stage_from("%s/%s" % (BASELINE_DIR, version))
+
+    def read_file(self, version, name):
+        """
+        Returns contents of file shipped with version.
+        """
+        offset, length = self.entries[version]['files'][name]
+        return self.__read(offset, length)
+
+    def __read(self, offset, length):
+        start = self.data_offset + offset
+        return self.data[start:start + length]
+
+    def __load_stage_from(self, key):
+        entry = self.entries.get(key)
+        if entry is None or STAGE_FILE not in entry['files']:
+            raise Exception("Could not find version file %s in %s" % (key, self.path))
+        if self.use_compiled and entry['code'] is not None:
+            code = marshal.loads(self.__read(*entry['code']))
+        else:
+            code = compile(self.read_file(key, STAGE_FILE), "%s/%s/%s" % (self.path, key, STAGE_FILE), 'exec')
+        stage_module = {}
+        exec code in stage_module
+        Stage = stage_module['Stage']
+        stage = Stage()
+        stage.current_path = self.__extract(key)
+        return stage
+
+    def __extract(self, key):
+        """
+        Extracts files shipped with stage, if there are any. Returns directory path.
+        """
+        path = os.path.abspath(j(self.extract_dir, key))
+        names = [ name for name in self.entries[key]['files'] if name != STAGE_FILE ]
+        for name in names:
+            target = j(path, name)
+            if os.path.isfile(target):
+                continue
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            write_file_atomically(target, self.read_file(key, name))
+        return path
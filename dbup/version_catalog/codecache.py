@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import imp
+import time
+import errno
+import marshal
+import hashlib
+import threading
+
+from dbup.version_catalog import MTIME_GRANULARITY, write_file_atomically
+
+
+j = os.path.join
+
+code_caches = {}
+code_caches_lock = threading.Lock()
+
+def get_code_cache(cache_dir=None):
+    """
+    Returns CodeCache for cache_dir, creating it on first request.
+    Caches are shared within the process, so stages loaded by one catalog
+    are not compiled again by another one, e.g. when many databases are
+    upgraded or rehearsed from the same catalog.
+    """
+    code_caches_lock.acquire()
+    try:
+        code_cache = code_caches.get(cache_dir)
+        if code_cache is None:
+            code_cache = CodeCache(cache_dir)
+            code_caches[cache_dir] = code_cache
+        return code_cache
+    finally:
+        code_caches_lock.release()
+
+
+class CodeCache(object):
+    """
+    Keeps compiled code of stage files, so loading the same stage again
+    does not parse and compile it again.
+    Code is remembered in process for up to 'size' files, least recently used
+    ones are forgotten first. It is looked up by path, size and mtime of the file,
+    if they have not changed the file is not even read.
+    If cache_dir is specified, code is also stored there in marshal format,
+    looked up by path and sha1 of the contents, so that other processes only
+    have to read the file.
+    """
+    def __init__(self, cache_dir=None, size=1024):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.lock = threading.Lock()
+        # (path, size, mtime) => [code, last use]
+        self.entries = {}
+        self.uses = 0
+
+    def get_code(self, path):
+        """
+        Returns code object compiled from file at path.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        signature = (path, st.st_size, st.st_mtime)
+        # file modified that recently may be modified again without mtime change
+        trusted = time.time() - st.st_mtime >= MTIME_GRANULARITY
+        if trusted:
+            code = self.__get(signature)
+            if code is not None:
+                return code
+        f = open(path, 'rb')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        key = hashlib.sha1("%s\0%s" % (path, hashlib.sha1(source).hexdigest())).hexdigest()
+        code = self.__read(key)
+        if code is None:
+            code = compile(source, path, 'exec')
+            self.__write(key, code)
+        if trusted:
+            self.__put(signature, code)
+        return code
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def __get(self, signature):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(signature)
+            if entry is None:
+                return None
+            self.uses += 1
+            entry[1] = self.uses
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def __put(self, signature, code):
+        self.lock.acquire()
+        try:
+            self.uses += 1
+            self.entries[signature] = [code, self.uses]
+            if len(self.entries) > self.size:
+                # evict least recently used quarter at once, so it is not done on every put
+                entries = sorted(self.entries.items(), key=lambda item: item[1][1])
+                for signature, _entry in entries[:max(1, self.size // 4)]:
+                    del self.entries[signature]
+        finally:
+            self.lock.release()
+
+    def __path(self, key):
+        if not self.cache_dir:
+            return None
+        return j(self.cache_dir, "%s.code" % key)
+
+    def __read(self, key):
+        path = self.__path(key)
+        if path is None:
+            return None
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                data = f.read()
+                magic = imp.get_magic()
+                # file written by another python version, its bytecode differs
+                if data[:len(magic)] != magic:
+                    return None
+                return marshal.loads(data[len(magic):])
+            except (IOError, EOFError, ValueError, TypeError):
+                # truncated or otherwise broken file, compile again
+                return None
+        finally:
+            f.close()
+
+    def __write(self, key, code):
+        path = self.__path(key)
+        if path is None:
+            return
+        # if code cannot be saved, stage is compiled again next time
+        try:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            write_file_atomically(path, imp.get_magic() + marshal.dumps(code))
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+
+from dbup.version_catalog import BASELINE_DIR, write_file_atomically
+
+
+j = os.path.join
+
+BASELINE_STAGE = '''import os
+
+from dbup.database.helpers import exec_sql_file
+from dbup.worker import IrreversibleStage
+
+
+class Stage(object):
+    """
+    Baseline that replaces versions up to and including %(version)s on fresh installations.
+    Generated by dbup squash, do not edit.
+    """
+    # must be complete before any other stage starts, see dbup.worker.parallel
+    barrier = True
+    # in the order they were squashed, baseline is not used if manager orders them differently
+    squashed_versions = %(versions)r
+
+    def up(self, session):
+        exec_sql_file(session, os.path.join(self.current_path, 'baseline.sql'))
+
+    def down(self, _session):
+        raise IrreversibleStage(version=%(version)r,
+                                reason="baseline is only for fresh installations, individual stages revert it")
+'''
+
+
+class SquashError(Exception):
+    pass
+
+
+class EmptyResult(object):
+    """
+    Result of a statement that was recorded but not executed.
+    """
+    rowcount = -1
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def scalar(self):
+        return None
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+
+class RecordingSession(object):
+    """
+    Session that records every statement stages execute.
+    If session is specified, statements are also executed through it (e.g. on a scratch database,
+    so stages that read their own results still work), otherwise nothing is executed at all.
+    Only plain statements can be recorded, statements with bound parameters cannot be
+    turned back into SQL reliably and raise SquashError.
+    """
+    def __init__(self, session=None):
+        self.session = session
+        self.statements = []
+        self.transaction_active = False
+        if session is not None:
+            self.connection = session.connection
+        else:
+            self.connection = None
+
+    def execute(self, expression, *args, **kwargs):
+        if args or kwargs:
+            raise SquashError("Statement with parameters cannot be squashed: %s" % expression)
+        if not isinstance(expression, basestring):
+            compiled = expression.compile()
+            if compiled.params:
+                raise SquashError("Statement with parameters cannot be squashed: %s" % expression)
+            expression = unicode(compiled)
+        statement = expression.strip().rstrip(';').strip()
+        if statement:
+            self.statements.append(statement)
+        if self.session is None:
+            return EmptyResult()
+        return self.session.execute(expression)
+
+    def report_progress(self, done, total=None, unit='rows'):
+        pass
+
+    def begin(self):
+        self.transaction_active = True
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        if self.session is not None:
+            self.session.commit()
+        self.transaction_active = False
+
+    def rollback(self):
+        if self.session is not None:
+            self.session.rollback()
+        self.transaction_active = False
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+def get_squashed_versions(catalog, to_version, sort_key=None):
+    """
+    Returns versions from the first one up to and including to_version,
+    ordered by sort_key like Manager orders them.
+    """
+    available_versions = catalog.get_available_versions()
+    if sort_key is not None:
+        available_versions.sort(key=sort_key)
+    if to_version not in available_versions:
+        raise SquashError("Version %s is not available" % to_version)
+    return available_versions[:available_versions.index(to_version)+1]
+
+def record_statements(catalog, to_version, session=None, sort_key=None):
+    """
+    Runs 'up' of every stage from the first one up to and including to_version
+    and returns list of statements they executed.
+    """
+    recorder = RecordingSession(session)
+    for version in get_squashed_versions(catalog, to_version, sort_key):
+        catalog.load_stage(version).up(recorder)
+    recorder.commit()
+    return recorder.statements
+
+def write_baseline(catalog_path, to_version, statements, versions=None):
+    """
+    Writes baseline stage for to_version into catalog, replacing existing baseline.
+    versions - versions squashed into baseline, in order.
+    """
+    baseline_root = j(catalog_path, BASELINE_DIR)
+    if os.path.isdir(baseline_root):
+        shutil.rmtree(baseline_root)
+    baseline_path = j(baseline_root, to_version)
+    os.makedirs(baseline_path)
+    chunks = []
+    for statement in statements:
+        if '--' in statement.splitlines()[-1]:
+            # semicolon must not end up in a trailing comment
+            statement += "\n"
+        if isinstance(statement, unicode):
+            statement = statement.encode('utf-8')
+        chunks.append("%s;\n\n" % statement)
+    write_file_atomically(j(baseline_path, 'baseline.sql'), "".join(chunks))
+    write_file_atomically(j(baseline_path, '__init__.py'), BASELINE_STAGE % {'version': to_version,
+                                                                               'versions': versions})
+    return baseline_path
+
+def squash(catalog, catalog_path, to_version, session=None, sort_key=None):
+    """
+    Squashes all versions up to and including to_version into baseline stage
+    which is used instead of them on fresh installations.
+    Individual stages are kept for existing installations and for downgrades.
+    session - optional scratch session to replay stages on, see RecordingSession.
+    sort_key - key versions are ordered by, must be the same one upgrades use.
+    Returns path of the baseline directory.
+    """
+    statements = record_statements(catalog, to_version, session, sort_key)
+    return write_baseline(catalog_path, to_version, statements,
+                          get_squashed_versions(catalog, to_version, sort_key))
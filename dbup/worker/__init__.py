@@ -24,13 +24,46 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
+import os
+import time
+import datetime
+
 import dbup.database.backend
 from dbup import events
+from dbup.database.helpers import connection_has_table
 
 
 class NoInstallation(Exception):
     pass
 
+class IrreversibleStage(Exception):
+    """
+    Raised by 'down' of stages that cannot be reverted.
+    """
+    def __init__(self, version=None, reason=None):
+        message = "Stage \"%s\" cannot be reverted" % version
+        if reason:
+            message += ": %s" % reason
+        Exception.__init__(self, message)
+        self.version = version
+        self.reason = reason
+
+class FailedToChangeVersion(Exception):
+    def __init__(self, version=None):
+        Exception.__init__(self, "Failed to set version to \"%s\"" % version)
+        self.version = version
+
+def get_stage_checksum(stage):
+    """
+    Returns checksum of stage files provided by catalog, or None.
+    Catalogs either set checksum attribute or give stage get_checksum
+    method, if calculating checksum is expensive.
+    """
+    if hasattr(stage, 'get_checksum'):
+        return stage.get_checksum()
+    return getattr(stage, 'checksum', None)
+
+
 class SqlWorker(object):
     """
     Class that implements sql-interface to get/set current version.
@@ -38,9 +71,20 @@ class SqlWorker(object):
     and set_current_version, you just have to inherit this class and
     re-implement these methods.
     """
-    def __init__(self, connection_string='', version_table='dbup_version', backend=None):
+    def __init__(self, connection_string='', version_table='dbup_version', backend=None,
+                 engine=None, connection=None, checkpoint=False, history_table='dbup_history',
+                 profiler=None):
         """
         version_table - table where current version number is kept.
+        history_table - table where every applied stage is recorded with the time it was
+                        applied at, how long it took and checksum of its files.
+                        None disables history.
+        engine, connection - existing sqlalchemy engine or connection to use
+                             instead of opening new ones, ignored if backend is specified.
+        checkpoint - if False, all stages are run in one transaction and version is
+                     recorded at the end. If True, every stage is committed together
+                     with its version, so failed run can be resumed from the stage that failed.
+        profiler - dbup.database.profiler.StatementProfiler to record statements in.
         """
         # common events
         self.onNewTask = events.Event() # event triggered before doing any action
@@ -51,23 +95,35 @@ class SqlWorker(object):
         self.onFailedToChangeVersion = events.Event()
         self.onCleanedUp = events.Event()
         self.onFailedToCleanUp = events.Event()
+        self.onTaskProgress = events.Event() # (version, done, total, unit) reported by stage
+        self.onTaskMetrics = events.Event() # (version, metrics) after every stage, see measure
+        self.onTaskGroupMetrics = events.Event() # (metrics) after every upgrade/downgrade/uninstall
+        self.current_task = None
+        self.onNewTask += self.__remember_task
 
         self.is_table_present = False
 
         # NOTE example: 'sqlite:///relative/path/to/database.txt'
         self.connection_string = connection_string
         self.version_table = version_table
+        self.history_table = history_table
+        self.is_history_present = False
         if backend is None:
-            self.backend = dbup.database.backend.Backend(self.connection_string)
+            self.backend = dbup.database.backend.Backend(self.connection_string,
+                                                         engine=engine,
+                                                         connection=connection)
         else:
             self.backend = backend
         self.session = None
+        self.checkpoint = checkpoint
+        self.profiler = profiler
 
     def setup(self):
         """
         For internal use. Attempts to create database containing version information.
         """
         self.__maybe_init_session()
+        self.setup_history()
         if self.is_table_present:
             return
         try:
@@ -76,16 +132,78 @@ class SqlWorker(object):
         except:
             self.session.rollback()
 
+    def setup_history(self):
+        """
+        For internal use. Attempts to create history table, if history is enabled.
+        """
+        if not self.history_table or self.is_history_present:
+            return
+        self.__maybe_init_session()
+        try:
+            self.session.execute("create table %s (version char(50), applied_at timestamp, "
+                                 "duration float, checksum char(40));" % self.history_table)
+            self.session.commit()
+        except:
+            self.session.rollback()
+        self.is_history_present = True
+
+    def record_history(self, session, version, stage, duration):
+        """
+        For internal use. Records that stage has been applied, in the session specified.
+        """
+        if not self.history_table or not self.is_history_present:
+            return
+        self.forget_history(session, version)
+        session.execute("insert into %s values (:version, :applied_at, :duration, :checksum);" % self.history_table,
+                        {'version': version,
+                         'applied_at': datetime.datetime.utcnow(),
+                         'duration': duration,
+                         'checksum': get_stage_checksum(stage)})
+
+    def forget_history(self, session, version):
+        """
+        For internal use. Removes history of reverted stage, in the session specified.
+        """
+        if not self.history_table or not self.is_history_present:
+            return
+        session.execute("delete from %s where version = :version;" % self.history_table,
+                        {'version': version})
+
+    def get_history(self):
+        """
+        Returns list of (version, applied_at, duration, checksum) for every applied stage,
+        in order they were applied. Returns empty list if there is no history.
+        """
+        if not self.history_table:
+            return []
+        self.__maybe_init_session()
+        try:
+            ret = self.session.execute("select version, applied_at, duration, checksum from %s "
+                                       "order by applied_at;" % self.history_table)
+            records = ret.fetchall()
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            return []
+        self.is_history_present = True
+        return [ (version.strip(), applied_at, duration, checksum and checksum.strip() or None)
+                 for version, applied_at, duration, checksum in records ]
+
     def upgrade(self, stages):
         self.onNewTaskGroup()
         self.setup()
+        group_started = self.measure()
         current_stage = None
+        tasks = 0
         for stage_name, stage_instance in stages:
             current_stage = stage_name
-            self.onNewTask(current_stage)
-            stage_instance.up(self.session)
-            self.onTaskCompleted(current_stage)
-        self.set_current_version(current_stage) # commit comes from this function
+            self.__run_stage(current_stage, stage_instance, 'up')
+            tasks += 1
+            if self.checkpoint:
+                self.__checkpoint(current_stage)
+        if not self.checkpoint:
+            self.set_current_version(current_stage) # commit comes from this function
+        self.__group_completed('upgrade', group_started, tasks)
         self.session.close()
         self.onTaskGroupCompleted()
 
@@ -95,13 +213,24 @@ class SqlWorker(object):
         # we should not attempt to create table with version on downgrade,
         # it must be there, already.
         self.__maybe_init_session()
-        downgrade_to = stages[-1][0]
-        del stages[-1]
-        for stage_name, stage_instance in stages:
-            self.onNewTask(stage_name)
-            stage_instance.down(self.session)
-            self.onTaskCompleted(stage_name)
-        self.set_current_version(downgrade_to) # commit comes from this function
+        self.setup_history()
+        group_started = self.measure()
+        tasks = 0
+        # stages may be an iterator, the last item is the version we downgrade to,
+        # so every stage is run only once the next one is known.
+        previous = None
+        for stage in stages:
+            if previous is not None:
+                stage_name, stage_instance = previous
+                self.__run_stage(stage_name, stage_instance, 'down')
+                tasks += 1
+                if self.checkpoint:
+                    self.__checkpoint(stage[0])
+            previous = stage
+        if not self.checkpoint:
+            downgrade_to = previous[0]
+            self.set_current_version(downgrade_to) # commit comes from this function
+        self.__group_completed('downgrade', group_started, tasks)
         self.session.close()
         self.onTaskGroupCompleted()
 
@@ -111,18 +240,95 @@ class SqlWorker(object):
         # we should not attempt to create table with version on downgrade,
         # it must be there, already.
         self.__maybe_init_session()
-        for stage_name, stage_instance in stages:
-            self.onNewTask(stage_name)
-            stage_instance.down(self.session)
-            self.onTaskCompleted(stage_name)
+        self.setup_history()
+        group_started = self.measure()
+        tasks = 0
+        previous = None
+        for stage in stages:
+            if previous is not None:
+                self.__uninstall_stage(previous, stage[0])
+                tasks += 1
+            previous = stage
+        if previous is not None:
+            self.__uninstall_stage(previous, None)
+            tasks += 1
         self.cleanup()
+        self.__group_completed('uninstall', group_started, tasks)
         self.session.close()
         self.onTaskGroupCompleted()
 
+    def __uninstall_stage(self, stage, next_version):
+        stage_name, stage_instance = stage
+        self.__run_stage(stage_name, stage_instance, 'down')
+        if self.checkpoint and next_version is not None:
+            self.__checkpoint(next_version)
+
+    def __run_stage(self, stage_name, stage_instance, direction):
+        """
+        Calls stage's up or down method, firing task events around it.
+        """
+        self.onNewTask(stage_name)
+        started = self.measure()
+        self.session.stage = stage_name
+        try:
+            getattr(stage_instance, direction)(self.session)
+        finally:
+            self.session.stage = None
+        metrics = self.measure(started)
+        if direction == 'up':
+            self.record_history(self.session, stage_name, stage_instance, metrics['wall_time'])
+        else:
+            self.forget_history(self.session, stage_name)
+        self.onTaskMetrics(stage_name, metrics)
+        self.onTaskCompleted(stage_name)
+
+    def __group_completed(self, action, started, tasks):
+        metrics = self.measure(started)
+        metrics['action'] = action
+        metrics['tasks'] = tasks
+        self.onTaskGroupMetrics(metrics)
+
+    def measure(self, started=None, session=None):
+        """
+        Returns dictionary with wall_time and cpu_time in seconds, number of statements
+        executed and rows affected by them. If started is specified, returns difference
+        between now and started, which is a value returned by measure() earlier.
+        Statements are counted in worker's session unless other session is specified.
+        """
+        if session is None:
+            session = self.session
+        times = os.times()
+        now = {'wall_time': time.time(),
+               'cpu_time': times[0] + times[1],
+               'statements': 0,
+               'rows': 0}
+        if session:
+            now['statements'] = session.statement_count
+            now['rows'] = session.rows_affected
+        if started is None:
+            return now
+        return dict([ (key, now[key] - started[key]) for key in now ])
+
+    def __checkpoint(self, version):
+        """
+        Commits work done so far together with the version it brings database to.
+        """
+        if not self.set_current_version(version):
+            raise FailedToChangeVersion(version)
+
     def __maybe_init_session(self):
         if not self.session:
             connection = self.backend.connect()
-            self.session = dbup.database.backend.Session(connection)
+            close_connection = getattr(self.backend, 'owns_connection', True)
+            self.session = dbup.database.backend.Session(connection, close_connection=close_connection,
+                                                         profiler=self.profiler)
+            self.session.onProgress += self.__report_progress
+
+    def __remember_task(self, version):
+        self.current_task = version
+
+    def __report_progress(self, done, total, unit):
+        self.onTaskProgress(self.current_task, done, total, unit)
 
     def __create_table(self):
         self.session.execute("create table %s (current_version char(50));" % self.version_table)
@@ -133,7 +339,8 @@ class SqlWorker(object):
         Returns current version installed, or None.
         None supposed to mean that there is no installation at all.
         """
-        self.__maybe_init_session()
+        if not self.session:
+            return self.__query_current_version()
         try:
             ret = self.session.execute("select * from %s;" % self.version_table)
             record = ret.fetchone()
@@ -147,6 +354,39 @@ class SqlWorker(object):
         else:
             raise NoInstallation()
 
+    def __query_current_version(self):
+        """
+        Reads current version with a plain query on backend's connection,
+        so that asking for version alone needs no orm session.
+        """
+        connection = self.backend.connect()
+        try:
+            if not getattr(self.backend, 'owns_connection', True):
+                # caller's connection may be in the middle of caller's transaction,
+                # which is not ours to roll back, and a failed query would spoil it
+                # on postgres, so make sure the table is there before asking
+                if not connection_has_table(connection, self.version_table):
+                    raise NoInstallation()
+                record = connection.execute("select * from %s" % self.version_table).fetchone()
+                return self.__get_version(record)
+            transaction = connection.begin()
+            try:
+                record = connection.execute("select * from %s" % self.version_table).fetchone()
+            except Exception, _e:
+                transaction.rollback()
+                raise NoInstallation()
+            transaction.commit()
+        finally:
+            self.backend.disconnect()
+        return self.__get_version(record)
+
+    def __get_version(self, record):
+        if record is not None:
+            self.is_table_present = True # table with version is there
+            return record[0].strip()
+        else:
+            raise NoInstallation()
+
     def set_current_version(self, new_version):
         """
         Updates current version record in database.
@@ -179,4 +419,12 @@ class SqlWorker(object):
         except: # TBD: catch OperationalError from alchemy
             self.session.rollback()
             self.onFailedToCleanUp()
+            return
+        if self.history_table:
+            try:
+                self.session.execute("drop table %s;" % self.history_table)
+                self.session.commit()
+            except:
+                self.session.rollback()
+            self.is_history_present = False
 
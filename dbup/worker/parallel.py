@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 by Konstantin Merenkov <kmerenkov@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import sys
+import threading
+import Queue
+
+import dbup.database.backend
+from dbup.worker import SqlWorker, FailedToChangeVersion
+from dbup.database.helpers import get_dialect_name
+
+
+def get_dependencies(stages):
+    """
+    Returns dictionary of version => set of versions it waits for.
+    Stage declares dependencies with 'depends_on' attribute, list of versions.
+    Versions that are not in stages are considered to be installed already.
+    Stage without 'depends_on' waits for all stages before it, as usual.
+    Stage with true 'barrier' attribute waits for all stages before it,
+    and all stages after it wait for it.
+    """
+    names = [ name for name, _stage in stages ]
+    positions = dict([ (name, idx) for idx, name in enumerate(names) ])
+    dependencies = {}
+    last_barrier = None
+    for idx, (name, stage) in enumerate(stages):
+        declared = getattr(stage, 'depends_on', None)
+        if declared is None or getattr(stage, 'barrier', False):
+            dependencies[name] = set(names[:idx])
+        else:
+            deps = set()
+            for dependency in declared:
+                if dependency not in positions:
+                    continue
+                if positions[dependency] >= idx:
+                    raise ValueError("Version %s depends on %s, which is not before it" % (name, dependency))
+                deps.add(dependency)
+            if last_barrier is not None:
+                deps.add(last_barrier)
+            dependencies[name] = deps
+        if getattr(stage, 'barrier', False):
+            last_barrier = name
+    return dependencies
+
+
+class ParallelSqlWorker(SqlWorker):
+    """
+    Worker that runs independent stages of an upgrade at the same time,
+    each on its own connection and in its own transaction.
+    Stages declare what they need with 'depends_on' attribute, see get_dependencies:
+        class Stage(object):
+            depends_on = ['0041']
+    Version recorded in database is always the latest one with all stages
+    before it completed. Stages that completed ahead of it are remembered in
+    <version_table>_applied table, so they are not run again if upgrade is resumed.
+    The table is dropped once upgrade completes.
+    Downgrades and uninstalls are run one stage after another, like SqlWorker does.
+    Sqlite cannot have several writers, stages are run one after another there too.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        concurrency - how many stages may run at the same time.
+        Other arguments are the same as for SqlWorker.
+        """
+        self.concurrency = max(1, kwargs.pop('concurrency', 4))
+        SqlWorker.__init__(self, *args, **kwargs)
+        self.applied_table = "%s_applied" % self.version_table
+        self.events_lock = threading.RLock()
+
+    def upgrade(self, stages):
+        self.onNewTaskGroup()
+        self.setup()
+        self.__setup_applied_table()
+        group_started = self.measure()
+        # dependencies can only be worked out when all stages are known
+        stages = list(stages)
+        dependencies = get_dependencies(stages)
+        names = [ name for name, _stage in stages ]
+        instances = dict(stages)
+        concurrency = self.concurrency
+        if get_dialect_name(self.session) == 'sqlite':
+            concurrency = 1
+        done = self.__get_applied() & set(names)
+        pending = [ name for name in names if name not in done ]
+        running = set()
+        completed = Queue.Queue()
+        failure = None
+        prefix = self.__advance_prefix(names, -1, done)
+        tasks = 0
+        while pending or running:
+            if failure is None:
+                for name in list(pending):
+                    if len(running) >= concurrency:
+                        break
+                    if dependencies[name] <= done:
+                        pending.remove(name)
+                        running.add(name)
+                        self.__start_stage(name, instances[name], completed)
+            if not running:
+                break
+            name, exc_info = completed.get()
+            running.remove(name)
+            if exc_info is not None:
+                if failure is None:
+                    failure = exc_info
+                continue
+            done.add(name)
+            tasks += 1
+            prefix = self.__advance_prefix(names, prefix, done)
+        self.__group_completed_parallel(group_started, tasks)
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+        # nothing is ahead of recorded version anymore
+        self.session.execute("drop table %s;" % self.applied_table)
+        self.session.commit()
+        self.session.close()
+        self.onTaskGroupCompleted()
+
+    def __start_stage(self, name, stage, completed):
+        thread = threading.Thread(target=self.__run_stage_thread, args=(name, stage, completed))
+        thread.setDaemon(True)
+        thread.start()
+
+    def __run_stage_thread(self, name, stage, completed):
+        session = None
+        try:
+            session = dbup.database.backend.Session(self.backend.open_connection(), profiler=self.profiler)
+            session.onProgress += lambda done, total, unit: self.__fire(self.onTaskProgress, name, done, total, unit)
+            self.__fire(self.onNewTask, name)
+            started = self.measure(session=session)
+            session.stage = name
+            stage.up(session)
+            session.stage = None
+            metrics = self.measure(started, session=session)
+            # stage and the fact it is applied are committed together
+            self.record_history(session, name, stage, metrics['wall_time'])
+            session.execute("insert into %s values ('%s');" % (self.applied_table, name))
+            session.commit()
+            self.__fire(self.onTaskMetrics, name, metrics)
+            self.__fire(self.onTaskCompleted, name)
+        except:
+            exc_info = sys.exc_info()
+            if session is not None and session.session is not None:
+                try:
+                    session.rollback()
+                except Exception:
+                    pass
+            completed.put((name, exc_info))
+        else:
+            completed.put((name, None))
+        if session is not None and session.connection is not None:
+            session.close()
+
+    def __advance_prefix(self, names, prefix, done):
+        """
+        Records the latest version which has all versions before it done.
+        Returns its position in names.
+        """
+        new_prefix = prefix
+        while new_prefix + 1 < len(names) and names[new_prefix + 1] in done:
+            new_prefix += 1
+        if new_prefix != prefix:
+            for name in names[prefix+1:new_prefix+1]:
+                self.session.execute("delete from %s where version = '%s';" % (self.applied_table, name))
+            # commit comes from set_current_version
+            if not self.__fire(self.set_current_version, names[new_prefix]):
+                raise FailedToChangeVersion(names[new_prefix])
+        return new_prefix
+
+    def __fire(self, event, *args):
+        # subscribers are not expected to be thread safe
+        self.events_lock.acquire()
+        try:
+            return event(*args)
+        finally:
+            self.events_lock.release()
+
+    def __group_completed_parallel(self, started, tasks):
+        metrics = self.measure(started)
+        metrics['action'] = 'upgrade'
+        metrics['tasks'] = tasks
+        self.onTaskGroupMetrics(metrics)
+
+    def __setup_applied_table(self):
+        try:
+            self.session.execute("create table %s (version char(50));" % self.applied_table)
+            self.session.commit()
+        except:
+            self.session.rollback()
+
+    def __get_applied(self):
+        try:
+            ret = self.session.execute("select version from %s;" % self.applied_table)
+            applied = set([ row[0].strip() for row in ret.fetchall() ])
+            self.session.commit()
+            return applied
+        except Exception:
+            self.session.rollback()
+            return set()
+
+    def cleanup(self):
+        SqlWorker.cleanup(self)
+        try:
+            self.session.execute("drop table %s;" % self.applied_table)
+            self.session.commit()
+        except:
+            self.session.rollback()
@@ -55,10 +55,18 @@ setup(name='dbup',
       url='http://github.com/kmerenkov/dbup/tree/master',
       packages=['dbup',
                 'dbup/database',
+                'dbup/fleet',
                 'dbup/manager',
                 'dbup/version_catalog',
                 'dbup/worker',
                 ],
-      py_modules=['dbup/events'],
+      py_modules=['dbup/check',
+                  'dbup/compat',
+                  'dbup/events',
+                  'dbup/metrics',
+                  'dbup/progress',
+                  'dbup/rehearsal',
+                  'dbup/template_cache',
+                  ],
       scripts=['bin/dbup']
       )